@@ -115,6 +115,8 @@ class PathsConfig(BaseConfig):
     cache_file: str
     models_dir: str
     api_embeddings_cache_file: str
+    api_embeddings_store_file: str = "data/api_embeddings_cache.sqlite3"
+    local_embeddings_cache_file: str = "data/local_embeddings_cache.pkl"
     label_images_cache_file: str
     resource_packs_dir: str = "resource_packs"
 
@@ -126,9 +128,62 @@ class ApiConfig(BaseConfig):
     embedding_models: OpenaiConfig
     vlm_models: OpenaiConfig
 
+class HttpConfig(BaseConfig):
+    connect_timeout: float = 10  # 建立连接的超时（秒）
+    keepalive_expiry: float = 120  # 空闲连接保持的时间（秒），期间的请求不需要重新握手
+    max_connections: int = 20  # 每个接口地址和api key的最大连接数
+    max_keepalive_connections: int = 10  # 连接池中保持的空闲连接数
+    max_retries: int = 2  # 连接错误和服务端错误的重试次数，由限流器重试，每次重试都计入限流额度
+    read_timeout: float = 60  # 等待响应的超时（秒）
+    warm_up: bool = True  # 启动时在后台预先建立到各接口的连接
+
 class MiscConfig(BaseConfig):
     adapt_for_old_version: bool
 
+class EmbeddingConfig(BaseConfig):
+    api_cache_dtype: str = 'float16'  # 嵌入向量存储的精度: float16 / float32
+    api_cache_max_entries: int = 200000  # 嵌入向量存储的条目上限，超过时淘汰最久未使用的，0表示不限制
+    api_cache_flush_interval: float = 5  # 后台把新向量写入磁盘的间隔（秒）
+    batch_size: int = 64  # 生成缓存时每个嵌入请求包含的标签数
+    cache_parity_min_cosine: float = 0.98  # 本地模型与API同一模型的向量最小余弦相似度，达到时两种模式共用缓存
+    concurrency: int = 4  # 生成缓存时同时进行的嵌入请求数
+    failover_enabled: bool = True  # API模式下API变慢或出错时，查询改用已加载且与API向量一致的本地模型
+    failover_latency_budget_ms: float = 1500  # API查询嵌入最近请求的p95延迟上限（毫秒），超过时改用本地模型
+    failover_max_error_rate: float = 0.2  # API查询嵌入最近请求的错误率上限，超过时改用本地模型
+    failover_probe_interval: float = 10  # 改用本地模型期间探测API是否恢复的间隔（秒）
+    failover_request_timeout: float = 5  # 有本地模型兜底时单次API查询请求的超时（秒）
+    failover_window: int = 50  # 统计延迟和错误率的最近请求数
+    inference_worker: bool = False  # 本地模型放在独立的推理进程中，所有会话共享一份模型
+    intra_op_threads: int = 0  # 本地推理使用的线程数，0表示由推理库决定
+    local_backend: str = 'torch'  # 本地推理后端: torch / onnx（只有CPU时更快）
+    local_batch_size: int = 128  # 本地模式生成缓存时每批编码的标签数，标签按长度分桶
+    local_query_cache_size: int = 1024  # 本地模式内存中缓存的查询向量数，0表示不缓存
+    model_memory_budget_mb: float = 0  # 已加载的本地模型总内存上限（MB），超过时卸载最久未使用的模型，0表示不限制
+    onnx_quantize_int8: bool = False  # ONNX后端是否使用动态int8量化
+    onnx_parity_min_cosine: float = 0.99  # 首次导出ONNX模型时与PyTorch结果的最小余弦相似度，低于该值回退到PyTorch
+    preload_default_model: bool = False  # 主要使用本地模式时开启：进程启动后在后台预加载一次models.default_model
+    worker_max_batch_size: int = 256  # 推理进程合并多个请求时每批最多的文本数
+    worker_max_wait_ms: float = 5  # 推理进程收到请求后等待其他请求一起推理的最长时间（毫秒）
+
+class RateLimitConfig(BaseConfig):
+    rpm: int = 0  # 每分钟请求数上限，0表示不限制
+    tpm: int = 0  # 每分钟token数上限，0表示不限制
+
+class SearchConfig(BaseConfig):
+    ann_enabled: bool = True
+    ann_min_size: int = 20000  # 标签数少于该值时使用精确搜索，也不为资源包构建ANN索引
+    ann_n_probe: int = 8  # 查询时探测的倒排列表数，越大召回越高、延迟越高
+    ann_n_lists: int = 0  # 倒排列表数，0表示自动取sqrt(标签数)
+    index_dtype: str = 'float32'  # 索引存储精度: float32 / float16 / int8
+    rerank_candidates: int = 200  # 量化粗排后用全精度向量重排的候选数
+    result_cache_size: int = 256  # 搜索结果缓存的条目数，0表示不缓存
+    result_cache_ttl: float = 600  # 搜索结果缓存的有效期（秒），0表示不过期
+    validity_scan_interval: float = 60  # 后台扫描资源包目录、更新失效图片的间隔（秒），0表示只在加载缓存时扫描
+
+class IndexingConfig(BaseConfig):
+    dedup_enabled: bool = True  # 近似重复图片的标签合并到聚类代表图片上，每个聚类只索引代表图片
+    dedup_similarity: float = 0.9  # 像素级相似度达到该值视为近似重复（指纹只用于筛选候选）
+
 class ResourcePackConfig(BaseConfig):
     enabled: bool = False
     path: Optional[str] = None
@@ -158,6 +213,8 @@ class ConfigCache:
     def __init__(self):
         self.config:dict|None = None
         self.modify_config_lock = threading.Lock()
+        # 配置每保存一次加一，长期存活的服务实例据此判断是否需要刷新
+        self.generation = 0
     def set_config(self, config_):
         self.modify_config_lock.acquire()
         self.config = config_
@@ -165,6 +222,7 @@ class ConfigCache:
     def del_config(self):
         self.modify_config_lock.acquire()
         self.config = None
+        self.generation += 1
         self.modify_config_lock.release()
 
     def get_config(self):
@@ -178,11 +236,25 @@ class ConfigCache:
 
 config_cache = ConfigCache()
 
+def get_config_generation() -> int:
+    """获取配置的版本号，配置文件被修改后版本号会增加"""
+    return config_cache.generation
+
 class Config(BaseConfig):
     api: ApiConfig
     models: ModelsConfig
     paths: PathsConfig
     misc: MiscConfig
+    embedding: EmbeddingConfig = EmbeddingConfig()
+    search: SearchConfig = SearchConfig()
+    indexing: IndexingConfig = IndexingConfig()
+    http: HttpConfig = HttpConfig()
+    # 每个接口的限流配置：embedding为嵌入接口，vlm为图片打标，llm为搜索增强
+    rate_limits: Dict[str, RateLimitConfig] = {
+        'embedding': RateLimitConfig(rpm=1800),
+        'llm': RateLimitConfig(rpm=1000, tpm=50000),
+        'vlm': RateLimitConfig(rpm=1000, tpm=50000),
+    }
     resource_packs: Dict[str, ResourcePackConfig] = {}
 
     # CONFIG_SOURCES = [
@@ -263,6 +335,15 @@ class Config(BaseConfig):
         """获取缓存文件的绝对路径"""
         return os.path.join(self.base_dir, self.paths.api_embeddings_cache_file)
 
+    def get_abs_api_store_file(self) -> str:
+        """获取嵌入向量存储（SQLite，API和本地模式共用）的绝对路径"""
+        return os.path.join(self.base_dir, self.paths.api_embeddings_store_file)
+
+    def get_abs_local_cache_file(self, model_name: str) -> str:
+        """获取旧版本本地模型嵌入缓存文件的绝对路径，每个模型一个文件，加载模型时导入向量存储"""
+        cache_file = self.paths.local_embeddings_cache_file.replace('.pkl', f'_{model_name.replace("/", "_")}.pkl')
+        return os.path.join(self.base_dir, cache_file)
+
     def get_label_images_cache_file(self) -> str:
         """获取缓存文件的绝对路径"""
         return os.path.join(self.base_dir,self.paths.label_images_cache_file)
@@ -239,6 +239,10 @@ with st.sidebar:
             on_change=on_model_change,
             help="选择合适的模型以平衡性能和资源消耗"
         )
+        resident_models = st.session_state.search_engine.embedding_service.get_resident_models()
+        if resident_models:
+            st.caption("已加载模型: " + "，".join(f"{key} {size / 1024 ** 2:.0f}MB"
+                                               for key, size in resident_models.items()))
         
         # 模型下载和重新下载按钮
         if not st.session_state.search_engine.embedding_service.is_model_downloaded(st.session_state.model_name):
@@ -338,7 +342,7 @@ with st.sidebar:
                         # 显示缓存状态
                         cache_generated = st.session_state.search_engine.resource_pack_manager.is_pack_cache_generated(
                             pack_id, 
-                            st.session_state.search_engine.embedding_service.selected_model
+                            st.session_state.search_engine.embedding_service.cache_tag
                         )
                         if cache_generated:
                             st.success("缓存已生成", icon="✅")
@@ -0,0 +1,137 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+# 每次参与k-means分配的行数，避免(行数, 聚类数)的相似度矩阵过大
+_ASSIGN_CHUNK_ROWS = 65536
+
+
+def _assign(embeddings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """把每一行分配给点积最大的聚类中心"""
+    labels = np.empty(embeddings.shape[0], dtype=np.int32)
+    for start in range(0, embeddings.shape[0], _ASSIGN_CHUNK_ROWS):
+        chunk = embeddings[start:start + _ASSIGN_CHUNK_ROWS]
+        labels[start:start + chunk.shape[0]] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(embeddings: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """球面k-means（向量已归一化，用点积作为相似度），返回归一化后的聚类中心"""
+    rng = np.random.default_rng(seed)
+    n = embeddings.shape[0]
+    centroids = embeddings[rng.choice(n, size=n_clusters, replace=False)].astype(np.float32)
+    labels = None
+    for _ in range(n_iter):
+        new_labels = _assign(embeddings, centroids)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, embeddings)
+        counts = np.bincount(labels, minlength=n_clusters)
+        # 空聚类重新随机选取一个样本作为中心
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = embeddings[rng.choice(n, size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = sums / norms
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """IVF-flat近似最近邻索引
+
+    用k-means把标签向量划分到若干倒排列表中，查询时只在与查询最接近的n_probe个列表里做精确打分。
+    n_probe越大召回越高，延迟也越高。倒排列表以CSR形式保存：list_ids按列表顺序排列行号，
+    list_offsets[i]:list_offsets[i+1]是第i个列表的范围。
+    """
+
+    VERSION = 1
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_ids: np.ndarray,
+                 n_rows: int, checksum: float):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.n_rows = n_rows
+        self.checksum = checksum
+
+    @staticmethod
+    def compute_checksum(embeddings: np.ndarray) -> float:
+        """用于判断持久化的索引是否仍然对应当前的缓存数据"""
+        return float(np.asarray(embeddings, dtype=np.float64).sum())
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, n_lists: int = 0, n_iter: int = 20, seed: int = 0) -> 'IVFIndex':
+        """构建索引，n_lists为0时取sqrt(行数)"""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        n = embeddings.shape[0]
+        n_lists = cls.resolve_n_lists(n, n_lists)
+        centroids = spherical_kmeans(embeddings, n_lists, n_iter=n_iter, seed=seed)
+        labels = _assign(embeddings, centroids)
+        list_ids = np.argsort(labels, kind='stable').astype(np.int64)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=list_offsets[1:])
+        return cls(centroids, list_offsets, list_ids, n, cls.compute_checksum(embeddings))
+
+    @staticmethod
+    def resolve_n_lists(n_rows: int, n_lists: int = 0) -> int:
+        """实际使用的倒排列表数，n_lists为0时取sqrt(行数)"""
+        if n_lists <= 0:
+            n_lists = int(np.sqrt(n_rows))
+        return max(1, min(n_lists, n_rows))
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    def candidates(self, query_embedding: np.ndarray, n_probe: int) -> np.ndarray:
+        """返回查询向量最接近的n_probe个倒排列表中的所有行号"""
+        n_probe = max(1, min(n_probe, self.n_lists))
+        centroid_scores = self.centroids @ np.asarray(query_embedding, dtype=np.float32)
+        if n_probe < self.n_lists:
+            probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        else:
+            probe = np.arange(self.n_lists)
+        return np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probe])
+
+    def matches(self, embeddings: np.ndarray) -> bool:
+        """检查索引是否与给定的嵌入矩阵对应"""
+        return (embeddings.shape[0] == self.n_rows and
+                np.isclose(self.compute_checksum(embeddings), self.checksum, rtol=1e-6))
+
+    def save(self, path: str) -> None:
+        """保存到npz文件"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # np.savez会自动补.npz后缀，先写临时文件再替换，避免中途失败留下损坏的索引
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+                 version=np.int64(self.VERSION),
+                 centroids=self.centroids,
+                 list_offsets=self.list_offsets,
+                 list_ids=self.list_ids,
+                 n_rows=np.int64(self.n_rows),
+                 checksum=np.float64(self.checksum))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['IVFIndex']:
+        """从npz文件加载，文件不存在或版本不符时返回None"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != cls.VERSION:
+                    return None
+                return cls(data['centroids'], data['list_offsets'], data['list_ids'],
+                           int(data['n_rows']), float(data['checksum']))
+        except (OSError, KeyError, ValueError) as e:
+            print(f"加载ANN索引 {path} 失败: {str(e)}")
+            return None
+
+
+def get_ann_file(cache_file: str) -> str:
+    """ANN索引保存在对应缓存文件旁边"""
+    return os.path.splitext(cache_file)[0] + '_ivf.npz'
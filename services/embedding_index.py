@@ -0,0 +1,283 @@
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from services.ann_index import IVFIndex
+from services.quantization import QuantizedMatrix
+
+
+class EmbeddingIndex:
+    """向量化检索索引
+
+    每个资源包不重复的标签向量是一个float32分段（通常是内存映射的列式缓存），全局第j行向量对应labels[j]。
+    图片的元数据保存在平行的数组里，图片到标签的映射为CSR：第i张图片的标签行号为label_ids[indptr[i]:indptr[i+1]]。
+    查询时每个分段只需要一次矩阵向量乘法，每个标签只打分一次，再用np.maximum.reduceat得到每张图片的最高相似度。
+    启用量化后先在压缩矩阵上粗排，再对前rerank_candidates个候选标签用全精度向量重排。
+    """
+
+    def __init__(self,
+                 segments: List[np.ndarray],
+                 labels: List[str],
+                 indptr: np.ndarray,
+                 label_ids: np.ndarray,
+                 filepaths: List[str],
+                 filenames: List[str],
+                 types: List[str],
+                 pack_ids: List[str],
+                 cluster_ids: Optional[List[Optional[int]]] = None,
+                 segment_pack_ids: Optional[List[str]] = None):
+        self.segments = [np.asarray(segment, dtype=np.float32) for segment in segments]
+        # offsets[i]:offsets[i+1]是第i个分段的全局标签行范围
+        self.offsets = np.cumsum([0] + [segment.shape[0] for segment in self.segments])
+        self.labels = np.asarray(labels, dtype=object)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.label_ids = np.asarray(label_ids, dtype=np.int64)
+        # 没有标签的图片（正常不会出现）不参与reduceat，相似度为-inf；
+        # 相邻两张有标签的图片的起点之间正好是前一张图片的全部标签，最后一张有标签的图片归约到末尾
+        self._empty = np.diff(self.indptr) == 0
+        self._has_empty = bool(self._empty.any())
+        self._starts = self.indptr[:-1][~self._empty]
+        # 每个分段所属的资源包，用于挂载ANN索引
+        self.segment_pack_ids = segment_pack_ids or [None] * len(self.segments)
+        self.filepaths = np.asarray(filepaths, dtype=object)
+        self.filenames = np.asarray(filenames, dtype=object)
+        self.types = np.asarray(types, dtype=object)
+        self.pack_ids = np.asarray(pack_ids, dtype=object)
+        # 资源包内近似重复聚类编号，-1表示没有聚类信息
+        if cluster_ids is None:
+            cluster_ids = [None] * len(self.filepaths)
+        self.cluster_ids = np.fromiter((-1 if cid is None else cid for cid in cluster_ids), dtype=np.int64,
+                                       count=len(cluster_ids))
+        # 有效位图：图片文件已被删除的图片标记为False，打分时直接排除
+        self.valid = np.ones(len(self.filepaths), dtype=bool)
+        self._all_valid = True
+        # 各资源包挂载的ANN索引: (起始标签行, 结束标签行, 索引)
+        self.ann_segments: List[Tuple[int, int, IVFIndex]] = []
+        # 量化后的粗排矩阵，为None时直接用全精度矩阵打分
+        self.coarse: Optional[QuantizedMatrix] = None
+        self.rerank_candidates = 0
+
+    @classmethod
+    def from_columnar(cls, segments: List[Tuple[np.ndarray, Dict[str, List]]]) -> Optional['EmbeddingIndex']:
+        """从多个列式缓存(标签嵌入矩阵, 元数据)构建索引，矩阵不会被复制"""
+        segments = [(embeddings, columns) for embeddings, columns in segments
+                    if embeddings.shape[0] > 0 and len(columns['filepath']) > 0]
+        if not segments:
+            return None
+
+        def concat(name):
+            # 可选列在旧缓存中不存在时补None
+            return [value for _, columns in segments
+                    for value in columns.get(name, [None] * len(columns['filepath']))]
+
+        # 各分段的标签行号和CSR偏移加上前面分段的行数和标签映射数
+        label_offset = 0
+        nnz_offset = 0
+        indptr = [np.zeros(1, dtype=np.int64)]
+        label_ids = []
+        for embeddings, columns in segments:
+            segment_label_ids = np.asarray(columns['label_ids'], dtype=np.int64)
+            label_ids.append(segment_label_ids + label_offset)
+            indptr.append(np.asarray(columns['indptr'], dtype=np.int64)[1:] + nnz_offset)
+            label_offset += embeddings.shape[0]
+            nnz_offset += len(segment_label_ids)
+
+        return cls(
+            segments=[embeddings for embeddings, _ in segments],
+            labels=[label for _, columns in segments for label in columns['labels']],
+            indptr=np.concatenate(indptr),
+            label_ids=np.concatenate(label_ids),
+            filepaths=concat('filepath'),
+            filenames=concat('filename'),
+            types=concat('type'),
+            pack_ids=concat('pack_id'),
+            cluster_ids=concat('cluster_id'),
+            segment_pack_ids=[columns['pack_id'][0] for _, columns in segments],
+        )
+
+    def set_validity(self, existing_paths: Set[str]) -> bool:
+        """根据目录扫描得到的现有文件集合（规范化路径）更新有效位图，返回位图是否发生变化"""
+        valid = np.fromiter((os.path.normpath(path) in existing_paths for path in self.filepaths),
+                            dtype=bool, count=len(self.filepaths))
+        changed = not np.array_equal(valid, self.valid)
+        # 整体替换而不是原地修改，并发的查询总能看到一份完整的位图
+        self.valid = valid
+        self._all_valid = bool(valid.all())
+        return changed
+
+    def _apply_validity(self, scores: np.ndarray) -> np.ndarray:
+        """把失效图片的相似度置为-inf，scores的最后一维对应全部图片"""
+        if not self._all_valid:
+            scores[..., ~self.valid] = -np.inf
+        return scores
+
+    def _reduce_to_images(self, label_scores: np.ndarray) -> np.ndarray:
+        """标签相似度按CSR映射取每张图片的最大值，label_scores的最后一维对应全部标签"""
+        gathered = label_scores[..., self.label_ids]
+        if not self._has_empty:
+            return np.maximum.reduceat(gathered, self._starts, axis=-1)
+        scores = np.full(label_scores.shape[:-1] + self._empty.shape, -np.inf, dtype=label_scores.dtype)
+        if self._starts.size:
+            scores[..., ~self._empty] = np.maximum.reduceat(gathered, self._starts, axis=-1)
+        return scores
+
+    def quantize(self, dtype: str, rerank_candidates: int) -> None:
+        """启用量化粗排，全精度分段只在重排时按行读取"""
+        if dtype == 'float32':
+            return
+        self.coarse = QuantizedMatrix.quantize(self.segments, dtype)
+        self.rerank_candidates = rerank_candidates
+
+    def __len__(self) -> int:
+        """图片数"""
+        return len(self.filepaths)
+
+    @property
+    def n_labels(self) -> int:
+        """不重复的标签数，即矩阵的总行数"""
+        return int(self.offsets[-1])
+
+    def row_range(self, start: int, end: int) -> np.ndarray:
+        """取出连续的若干行，范围落在单个分段内时不复制"""
+        seg = int(np.searchsorted(self.offsets, start, side='right')) - 1
+        if end <= self.offsets[seg + 1]:
+            return self.segments[seg][start - self.offsets[seg]:end - self.offsets[seg]]
+        return self.take_rows(np.arange(start, end))
+
+    def take_rows(self, rows: np.ndarray) -> np.ndarray:
+        """按全局行号取出若干行"""
+        rows = np.asarray(rows, dtype=np.int64)
+        seg_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+        dim = self.segments[0].shape[1]
+        result = np.empty((rows.shape[0], dim), dtype=np.float32)
+        for seg in np.unique(seg_ids):
+            mask = seg_ids == seg
+            result[mask] = self.segments[seg][rows[mask] - self.offsets[seg]]
+        return result
+
+    def _dot(self, query_embedding: np.ndarray) -> np.ndarray:
+        return np.concatenate([segment @ query_embedding for segment in self.segments])
+
+    def pack_ranges(self) -> Dict[str, Tuple[int, int]]:
+        """每个资源包的标签在矩阵中占据的行范围，每个资源包是一个分段"""
+        return {pack_id: (int(self.offsets[seg]), int(self.offsets[seg + 1]))
+                for seg, pack_id in enumerate(self.segment_pack_ids) if pack_id is not None}
+
+    def attach_ann(self, pack_id: str, ann: IVFIndex) -> bool:
+        """为资源包挂载ANN索引，索引与当前数据不对应时拒绝挂载"""
+        pack_range = self.pack_ranges().get(pack_id)
+        if pack_range is None:
+            return False
+        start, end = pack_range
+        if not ann.matches(self.row_range(start, end)):
+            return False
+        self.ann_segments = [seg for seg in self.ann_segments if seg[0] != start]
+        self.ann_segments.append((start, end, ann))
+        return True
+
+    def get_ann(self, pack_id: str) -> Optional[IVFIndex]:
+        """资源包已挂载的ANN索引，没有时返回None"""
+        pack_range = self.pack_ranges().get(pack_id)
+        if pack_range is None:
+            return None
+        return next((ann for start, _, ann in self.ann_segments if start == pack_range[0]), None)
+
+    def _ann_candidates(self, query_embedding: np.ndarray, n_probe: int) -> np.ndarray:
+        """收集候选标签行：有ANN索引的资源包只取探测到的列表，其余资源包全部参与"""
+        covered = np.zeros(self.n_labels, dtype=bool)
+        parts = []
+        for start, end, ann in self.ann_segments:
+            covered[start:end] = True
+            parts.append(ann.candidates(query_embedding, n_probe) + start)
+        parts.append(np.flatnonzero(~covered))
+        return np.concatenate(parts)
+
+    def score(self, query_embedding: np.ndarray, n_probe: Optional[int] = None) -> np.ndarray:
+        """计算查询向量与每张图片的相似度，即图片各标签相似度的最大值（向量均已归一化，点积即余弦相似度）
+
+        指定n_probe且有ANN索引时只对候选标签打分，没有候选标签的图片以及失效图片的相似度为-inf。
+        """
+        return self._apply_validity(self._reduce_to_images(self.score_labels(query_embedding, n_probe)))
+
+    def score_labels(self, query_embedding: np.ndarray, n_probe: Optional[int] = None) -> np.ndarray:
+        """计算查询向量与所有不重复标签的相似度，未被ANN选为候选的标签为-inf"""
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        rows = None
+        if n_probe is not None and self.ann_segments:
+            rows = self._ann_candidates(query_embedding, n_probe)
+
+        if self.coarse is None:
+            if rows is None:
+                return self._dot(query_embedding)
+            partial = self.take_rows(rows) @ query_embedding
+        else:
+            partial = self.coarse.score(query_embedding, rows)
+            self._rerank(partial, query_embedding, rows)
+
+        if rows is None:
+            return partial
+        scores = np.full(self.n_labels, -np.inf, dtype=np.float32)
+        scores[rows] = partial
+        return scores
+
+    def _rerank(self, coarse_scores: np.ndarray, query_embedding: np.ndarray,
+                rows: Optional[np.ndarray] = None) -> None:
+        """用全精度向量重新计算粗排前rerank_candidates个候选的相似度（原地修改）
+
+        其余行保留量化后的近似相似度，量化误差远小于相似度之间的差距，不影响后续取前k个。
+        """
+        n = min(self.rerank_candidates, coarse_scores.shape[0])
+        if n <= 0:
+            return
+        if n < coarse_scores.shape[0]:
+            top = np.argpartition(-coarse_scores, n - 1)[:n]
+        else:
+            top = np.arange(n)
+        # 未参与打分的行保持-inf
+        top = top[np.isfinite(coarse_scores[top])]
+        top_rows = top if rows is None else rows[top]
+        # 内存映射时按行号顺序读取，减少随机访问
+        order = np.argsort(top_rows)
+        exact = self.take_rows(top_rows[order]) @ query_embedding
+        coarse_scores[top[order]] = exact
+
+    def score_many(self, query_embeddings: np.ndarray) -> np.ndarray:
+        """批量打分，一次矩阵乘法得到所有标签的相似度，再归约为形状为(查询数, 图片数)的相似度矩阵"""
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if self.coarse is None:
+            label_scores = np.concatenate([query_embeddings @ segment.T for segment in self.segments], axis=1)
+        else:
+            label_scores = self.coarse.score_many(query_embeddings)
+            for query_embedding, row_scores in zip(query_embeddings, label_scores):
+                self._rerank(row_scores, query_embedding)
+        return self._apply_validity(self._reduce_to_images(label_scores))
+
+    def best_labels(self, query_embedding: np.ndarray, images: np.ndarray) -> List[str]:
+        """返回每张图片中与查询最相似的标签文本，只对这些图片的标签用全精度向量重新计算"""
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        names = []
+        for image in images:
+            rows = self.label_ids[self.indptr[image]:self.indptr[image + 1]]
+            if len(rows) == 0:
+                names.append('')
+                continue
+            best = rows[0] if len(rows) == 1 else rows[int(np.argmax(self.take_rows(rows) @ query_embedding))]
+            names.append(self.labels[best])
+        return names
+
+    @staticmethod
+    def select_top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """用argpartition选出前k个，只对这k个排序"""
+        n = scores.shape[0]
+        if k <= 0 or n == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if k < n:
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(n)
+        order = np.argsort(-scores[candidates], kind='stable')
+        indices = candidates[order]
+        # 去掉ANN未覆盖的和失效的图片
+        indices = indices[np.isfinite(scores[indices])]
+        return indices, scores[indices]
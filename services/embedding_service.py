@@ -1,80 +1,291 @@
 import os
 import sys
 import time
+from contextlib import nullcontext
 
 import requests
 import openai
-from openai import OpenAI
-import pickle
 from config.settings import Config
-from typing import List, Optional, Union
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 import numpy as np
 from FlagEmbedding import BGEM3FlagModel
 from huggingface_hub import snapshot_download
 from tqdm import tqdm
-from services.utils import verify_folder
+from services.lru_cache import LRUCache
+from services.vector_store import VectorStore, get_vector_store, migrate_pickle_vectors
+from services.onnx_backend import (OnnxEmbeddingModel, check_parity, get_onnx_file, load_parity_result,
+                                   save_parity_result, PARITY_TEXTS)
+from services.inference_worker import RemoteModel
+from services.model_registry import get_model_registry, estimate_disk_size
+from services.failover_router import get_failover_router, BACKEND_API, BACKEND_LOCAL
+from services.single_flight import get_single_flight
+from services.http_clients import get_openai_client, warm_up
+from services.rate_limiter import get_rate_limiter, estimate_tokens, PRIORITY_INTERACTIVE, PRIORITY_BULK
 import threading
 
+# API模式使用的模型在models.embedding_models中的键；本地加载同一个模型时两种模式共用向量存储中的向量
+API_MODEL_KEY = 'bge-m3'
+# 本地模型没有通过与API向量的一致性检查时，向量存放在"<模型标识>@local"下，不与API的向量混用
+LOCAL_NAMESPACE_SUFFIX = '@local'
+PARITY_OK = 'ok'
+PARITY_MISMATCH = 'mismatch'
+# 一致性检查最多抽取的已缓存文本数，以及补齐参照向量时请求API的超时（秒）
+PARITY_SAMPLE_SIZE = 16
+PARITY_REQUEST_TIMEOUT = 15
+# 因API不可用而没有完成一致性检查时，多久之后（秒）再次检查
+PARITY_RETRY_INTERVAL = 600
+# 正在后台做一致性检查的模型，每个模型同时只检查一次
+_parity_running = set()
+_parity_lock = threading.Lock()
+
+# 默认模型每个进程只预加载一次
+_preloaded = False
+_preload_lock = threading.Lock()
+
+
+def _load_torch_model(model_path: str) -> BGEM3FlagModel:
+    """用PyTorch加载模型；只有GPU上才用fp16，CPU上fp16是模拟的，反而更慢"""
+    import torch
+    intra_op_threads = Config().embedding.intra_op_threads
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    return BGEM3FlagModel(model_path, use_fp16=torch.cuda.is_available())
+
+
+def _load_onnx_model(model_path: str):
+    """用ONNX Runtime加载模型，首次导出后与PyTorch结果做一致性检查；失败时回退到PyTorch
+
+    检查结果记录在onnx文件旁边，记录的最小余弦相似度低于阈值时直接使用PyTorch，不再重新导出。
+    """
+    embedding_config = Config().embedding
+    onnx_file = get_onnx_file(model_path, embedding_config.onnx_quantize_int8)
+    recorded = load_parity_result(onnx_file)
+    if recorded is not None and recorded < embedding_config.onnx_parity_min_cosine:
+        print(f"ONNX后端导出时未通过一致性检查（最小余弦相似度 {recorded:.4f}），使用PyTorch")
+        return _load_torch_model(model_path)
+    first_export = not os.path.exists(onnx_file)
+    try:
+        model = OnnxEmbeddingModel(model_path, embedding_config.onnx_quantize_int8,
+                                   embedding_config.intra_op_threads)
+    except Exception as e:
+        print(f"ONNX后端加载失败，使用PyTorch: {str(e)}")
+        return _load_torch_model(model_path)
+    if not first_export:
+        return model
+
+    reference = _load_torch_model(model_path)
+    min_cosine = check_parity(model, reference)
+    save_parity_result(onnx_file, min_cosine)
+    if min_cosine < embedding_config.onnx_parity_min_cosine:
+        print(f"ONNX后端与PyTorch结果不一致（最小余弦相似度 {min_cosine:.4f}），使用PyTorch")
+        os.remove(onnx_file)
+        return reference
+    print(f"ONNX后端一致性检查通过，最小余弦相似度 {min_cosine:.4f}")
+    return model
+
+
+def load_local_model(model_path: str):
+    """按embedding.local_backend配置加载本地模型，推理进程也使用这个函数"""
+    if Config().embedding.local_backend == 'onnx':
+        return _load_onnx_model(model_path)
+    return _load_torch_model(model_path)
+
 
 class EmbeddingService:
     def __init__(self):
         self.config = Config(keep_tracked=True)
         self.api_key = Config().api.embedding_models.api_key
         self.base_url = Config().api.embedding_models.base_url
-        self.local_models = {}
-        self.current_model = None
         self.mode = 'api'  # 'api' or 'local'
         self.selected_model = None
-        self.embedding_cache = {}
         self._get_embedding_cache()
+        # 本地模式最近使用的查询向量（float32，已归一化），命中时不需要查向量存储和转换精度
+        self.query_cache = LRUCache(Config().embedding.local_query_cache_size)
         self.cache_lock = threading.Lock()
-        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-        self.rpm_monitor = [0]
+        if Config().embedding.preload_default_model:
+            self._preload_default_model()
+        self.client = None
+        self._client_params = None
+        self._ensure_client()
+        # 与其他使用嵌入接口的服务共享同一个限流器
+        self.rate_limiter = get_rate_limiter('embedding')
+        # 所有会话共享：同一(模型, 文本)同时只有一个请求，并发的相同请求等待其结果
+        self._inflight = get_single_flight('embedding')
+
+    @property
+    def current_model(self):
+        """当前选择的本地模型，未加载或已被模型表卸载时为None
+
+        已加载的本地模型由进程内共享的模型表管理，会话不保留引用，每次使用时从模型表获取。
+        """
+        if self.mode != 'local' or not self.selected_model:
+            return None
+        return get_model_registry().get_if_loaded(self._model_key(self.selected_model))
+
+    def _ensure_client(self):
+        """api key或base url变化时才重新获取客户端，客户端及其连接池在进程内共享"""
+        params = (self.api_key, self.base_url)
+        if self.client is None or params != self._client_params:
+            self.client = get_openai_client(self.base_url, self.api_key)
+            self._client_params = params
+            warm_up(self.base_url, self.api_key)
+
+    def refresh_config(self):
+        """配置变更后刷新api key和base url，不重新加载嵌入缓存和本地模型"""
+        self.api_key = Config().api.embedding_models.api_key
+        self.base_url = Config().api.embedding_models.base_url
+        self._ensure_client()
+        # 限流器在进程内共享，重新获取只是让它按新的配置更新速率
+        self.rate_limiter = get_rate_limiter('embedding')
+
+    @property
+    def vector_store(self) -> VectorStore:
+        """API和本地两种模式、所有会话共用的向量存储，按模型标识区分"""
+        return get_vector_store()
 
     def _get_embedding_cache(self):
-        """获取嵌入缓存"""
+        """旧的API模式pickle缓存一次性导入向量存储；本地模式的旧缓存在加载模型时导入"""
+        migrate_pickle_vectors(Config().get_abs_api_cache_file(), self.vector_store)
+
+    @staticmethod
+    def _api_identity() -> str:
+        return Config().models.embedding_models[API_MODEL_KEY].name
+
+    @staticmethod
+    def _local_identity(model_name: str) -> str:
+        model_info = Config().models.embedding_models.get(model_name)
+        return model_info.name if model_info else model_name
+
+    @property
+    def model_identity(self) -> Optional[str]:
+        """当前模式使用的模型标识（HuggingFace仓库名），API和本地加载的同一模型标识相同"""
         if self.mode == 'api':
-            cache_file = Config().get_abs_api_cache_file()
-            verify_folder(cache_file)
-        else:
-            if not self.selected_model:
+            return self._api_identity()
+        if not self.selected_model:
+            return None
+        return self._local_identity(self.selected_model)
+
+    @property
+    def vector_namespace(self) -> Optional[str]:
+        """当前模式读写向量存储时使用的模型名"""
+        if self.mode == 'api':
+            return self._api_identity()
+        if not self.selected_model:
+            return None
+        return self._local_namespace(self.selected_model)
+
+    def _local_namespace(self, model_name: str) -> str:
+        """本地模型读写向量存储时使用的模型名
+
+        本地模型与API是同一模型且通过了一致性检查时与API共用模型标识，否则本地的向量单独存放。
+        """
+        identity = self._local_identity(model_name)
+        if identity != self._api_identity() or self.vector_store.get_meta(self._parity_key(model_name)) == PARITY_OK:
+            return identity
+        return identity + LOCAL_NAMESPACE_SUFFIX
+
+    @property
+    def cache_tag(self) -> Optional[str]:
+        """资源包缓存文件名中的模型部分，向量相同的模式使用同一份资源包缓存"""
+        namespace = self.vector_namespace
+        return namespace.replace('/', '_').replace('@', '_') if namespace else None
+
+    def _parity_key(self, model_name: str) -> str:
+        # 不同后端（torch/onnx量化）的结果可能不同，分别检查
+        return f'parity:{self._model_key(model_name)}'
+
+    def _parity_retry_key(self, model_name: str) -> str:
+        return f'parity_unavailable:{self._model_key(model_name)}'
+
+    def _needs_parity_check(self, model_name: str) -> bool:
+        """与API是同一模型、尚无检查结果，且最近PARITY_RETRY_INTERVAL秒内没有因API不可用而检查失败"""
+        if (self._local_identity(model_name) != self._api_identity() or
+                self.vector_store.get_meta(self._parity_key(model_name)) is not None):
+            return False
+        failed_at = self.vector_store.get_meta(self._parity_retry_key(model_name))
+        return failed_at is None or time.time() - float(failed_at) >= PARITY_RETRY_INTERVAL
+
+    def _start_parity_check(self, model_name: str, model) -> None:
+        """在后台线程做一致性检查，完成后导入旧的本地缓存，不阻塞切换模式的请求线程"""
+        parity_key = self._parity_key(model_name)
+        with _parity_lock:
+            if parity_key in _parity_running:
                 return
-            cache_file = Config().get_abs_cache_file().replace('.pkl', f'_{self.selected_model}.pkl')
-            verify_folder(cache_file)
+            _parity_running.add(parity_key)
+
+        def run():
+            try:
+                self._check_parity(model_name, model)
+                self._migrate_local_cache(model_name)
+            except Exception as e:
+                print(f"本地模型 {model_name} 一致性检查失败: {str(e)}")
+            finally:
+                with _parity_lock:
+                    _parity_running.discard(parity_key)
 
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as f:
-                self.embedding_cache = pickle.load(f)
+        threading.Thread(target=run, name='embedding-parity-check', daemon=True).start()
+
+    def _check_parity(self, model_name: str, model) -> None:
+        """本地模型与API的向量一致性检查，每个模型和后端只做一次，结果记录在向量存储中
+
+        参照向量取向量存储中API返回的向量，没有时用几条固定文本请求API，请求失败不重试；
+        无法请求时记录失败时间，PARITY_RETRY_INTERVAL秒后再检查。
+        """
+        if not self._needs_parity_check(model_name):
+            return
+        texts = self.vector_store.sample_texts(self._local_identity(model_name), PARITY_SAMPLE_SIZE) or PARITY_TEXTS
+        try:
+            reference = self._get_api_embeddings(texts, PRIORITY_BULK, timeout=PARITY_REQUEST_TIMEOUT, retries=0)
+        except Exception as e:
+            self.vector_store.set_meta(self._parity_retry_key(model_name), str(time.time()))
+            print(f"无法获取API向量，暂不与API共用缓存: {str(e)}")
+            return
+        parity_key = self._parity_key(model_name)
+        local = self._run_local_model(model_name, model, texts, PRIORITY_BULK)
+        min_cosine = float(np.min(np.sum(reference * local, axis=1)))
+        if min_cosine >= Config().embedding.cache_parity_min_cosine:
+            self.vector_store.set_meta(parity_key, PARITY_OK)
+            print(f"本地模型 {model_name} 与API向量一致（最小余弦相似度 {min_cosine:.4f}），两种模式共用缓存")
+        else:
+            self.vector_store.set_meta(parity_key, PARITY_MISMATCH)
+            print(f"本地模型 {model_name} 与API向量不一致（最小余弦相似度 {min_cosine:.4f}），单独缓存")
 
     def is_rpm_overload(self):
-        """检查RPM是否过载"""
-        pt = time.time()
-        send_count = 0
-        for k in self.rpm_monitor:
-            if pt - k > 60:
-                continue
-            send_count += 1
-        if send_count >= 1800:
-            return True
-        return False
+        """检查当前是否没有请求额度"""
+        return self.rate_limiter.is_saturated()
 
     def get_last_request_time(self):
         """获取最后一次请求的时间"""
-        return self.rpm_monitor[-1]
+        return self.rate_limiter.last_request_time
+
+    def _create_embeddings(self, payload: dict, texts: List[str], priority: int = PRIORITY_INTERACTIVE,
+                           retries: Optional[int] = None):
+        """在限流下请求嵌入接口，遇到429时按Retry-After等待后重试；交互式请求的延迟和成败记录到故障转移路由
+
+        retries指定时限流和请求失败都最多重试这么多次，为0时失败立即返回，否则按限流器的默认次数重试。
+        """
+        client = self.client
+        kwargs = {'priority': priority}
+        if retries is not None:
+            kwargs.update(max_retries=retries, transient_retries=retries)
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = self.rate_limiter.call(lambda: client.embeddings.create(**payload),
+                                              tokens=estimate_tokens(*texts), **kwargs)
+            ok = True
+            return response
+        finally:
+            # 批量请求文本多、排在交互式请求之后，延迟不代表查询的体验，不参与统计
+            if priority == PRIORITY_INTERACTIVE:
+                get_failover_router().record(BACKEND_API, time.perf_counter() - start, ok)
 
     def save_embedding_cache(self):
         """保存嵌入缓存"""
-        if self.mode == 'api':
-            cache_file = Config().get_abs_api_cache_file()
-        else:
-            if not self.selected_model:
-                return
-            cache_file = Config().get_abs_cache_file().replace('.pkl', f'_{self.selected_model}.pkl')
-
+        # 向量存储由后台线程定期写盘，这里只是把缓冲区立即写入
+        self.vector_store.flush()
         if sys.gettrace() is not None:
-            print(f'saving cache: {sum(len(i) for i in self.embedding_cache.values())}')
-        with open(cache_file, 'wb') as f:
-            pickle.dump(self.embedding_cache, f)
+            print(f'saving cache: {len(self.vector_store)}')
 
     def _download_model(self, model_name: str) -> None:
         """下载模型到本地"""
@@ -92,25 +303,18 @@ class EmbeddingService:
                 local_dir_use_symlinks=False
             )
 
-    def _load_local_model(self, model_name: str) -> None:
-        """加载本地模型"""
+    def _load_local_model(self, model_name: str):
+        """加载本地模型，返回模型"""
         try:
-            if model_name not in self.local_models:
-                model_path = Config().get_model_path(model_name)
-                if not os.path.exists(model_path):
-                    raise RuntimeError(f"模型 {model_name} 尚未下载")
-                print(f"正在加载模型 {model_name}...")
-                self.local_models[model_name] = BGEM3FlagModel(
-                    model_path,
-                    use_fp16=True
-                )
-            self.current_model = self.local_models[model_name]
+            model_path = Config().get_model_path(model_name)
+            if not os.path.exists(model_path):
+                raise RuntimeError(f"模型 {model_name} 尚未下载")
+            model = get_model_registry().get(self._model_key(model_name), self._model_loader(model_name),
+                                             estimate_disk_size(model_path), model_path)
         except Exception as e:
             print(f"模型加载失败: {str(e)}")
-            self.current_model = None
-            # 如果加载失败，从缓存中移除
-            if model_name in self.local_models:
-                del self.local_models[model_name]
+            # 如果加载失败，从模型表中移除
+            get_model_registry().evict(self._model_key(model_name))
             # 删除可能损坏的模型文件
             model_path = Config().get_model_path(model_name)
             if os.path.exists(model_path):
@@ -118,6 +322,64 @@ class EmbeddingService:
                 shutil.rmtree(model_path)
             raise RuntimeError(f"模型加载失败，请重新下载模型。错误信息: {str(e)}")
 
+        if self._needs_parity_check(model_name):
+            self._start_parity_check(model_name, model)
+        else:
+            self._migrate_local_cache(model_name)
+        return model
+
+    def _migrate_local_cache(self, model_name: str) -> None:
+        """旧版本本地模式的pickle缓存导入向量存储；一致性尚未检查时先不导入，避免导入到临时的命名空间"""
+        namespace = self._local_namespace(model_name)
+        if (namespace == self._local_identity(model_name) or
+                self.vector_store.get_meta(self._parity_key(model_name)) is not None):
+            migrate_pickle_vectors(Config().get_abs_local_cache_file(model_name), self.vector_store, namespace)
+
+    @staticmethod
+    def _model_key(model_name: str) -> str:
+        """模型表中的键，同一模型的不同后端分开保存"""
+        embedding_config = Config().embedding
+        backend = 'worker' if embedding_config.inference_worker else embedding_config.local_backend
+        return f"{model_name}@{backend}"
+
+    @staticmethod
+    def _model_loader(model_name: str):
+        """返回加载本地模型的函数；使用推理进程时只创建代理"""
+        def loader():
+            if Config().embedding.inference_worker:
+                # 模型由所有会话共享的推理进程持有，这里只保存代理
+                return RemoteModel(model_name)
+            print(f"正在加载模型 {model_name}...")
+            return load_local_model(Config().get_model_path(model_name))
+        return loader
+
+    def _preload_default_model(self) -> None:
+        """后台预加载默认模型，第一次查询时不需要等待模型加载；每个进程只预加载一次，之后由模型表按预算管理"""
+        global _preloaded
+        model_name = Config().models.default_model
+        if not model_name or not self.is_model_downloaded(model_name):
+            return
+        with _preload_lock:
+            if _preloaded:
+                return
+            _preloaded = True
+        model_path = Config().get_model_path(model_name)
+        loader = self._model_loader(model_name)
+        if Config().embedding.inference_worker:
+            create_proxy = loader
+
+            def loader():
+                # 代理本身不持有模型，让推理进程加载模型
+                model = create_proxy()
+                model.load()
+                return model
+        get_model_registry().preload(self._model_key(model_name), loader,
+                                     estimate_disk_size(model_path), model_path)
+
+    def get_resident_models(self) -> Dict[str, int]:
+        """当前进程中已加载的模型及其占用的内存（字节）"""
+        return get_model_registry().resident_sizes()
+
     def set_mode(self, mode: str, model_name: Optional[str] = None) -> None:
         """设置服务模式(api/local)和选择模型"""
         if mode not in ['api', 'local']:
@@ -134,11 +396,7 @@ class EmbeddingService:
                     self._load_local_model(model_name)
                 except Exception as e:
                     print(f"模型加载失败: {str(e)}")
-                    self.current_model = None
-            else:
-                self.current_model = None
         else:
-            self.current_model = None
             self.selected_model = None
 
     def download_selected_model(self) -> None:
@@ -167,57 +425,302 @@ class EmbeddingService:
             embedding = np.array(embedding)
         return embedding / np.linalg.norm(embedding)
 
+    def _update_api_key(self, key: Optional[str]) -> None:
+        """检查是否指定新的api key，如果指定则更新api key"""
+        with self.cache_lock:
+            if key is not None and key != self.api_key:
+                self.api_key = key
+                self._ensure_client()
+
     def get_embedding(self, text: str, key: str = None) -> np.ndarray:
         """获取文本嵌入并归一化"""
         if self.mode == 'api':
-            # API 模式
-            model_name = Config().models.embedding_models['bge-m3'].name
+            self._update_api_key(key)
+            return self._route_api_embeddings([text])[0]
+        # 本地模式，返回的已经是新的归一化向量
+        return self._encode_local([text])[0]
+
+    def get_embeddings(self, texts: List[str], key: str = None,
+                       priority: int = PRIORITY_INTERACTIVE) -> np.ndarray:
+        """批量获取文本嵌入并归一化，返回形状为(len(texts), 维度)的矩阵
+
+        API模式下未命中缓存的文本合并为一次请求，本地模式下只调用一次encode。
+        生成缓存时priority传PRIORITY_BULK，只使用交互式查询剩下的额度。
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        if self.mode == 'api':
+            self._update_api_key(key)
+            if priority == PRIORITY_INTERACTIVE:
+                return self._route_api_embeddings(texts)
+            return self._get_api_embeddings(texts, priority)
+        return self._encode_local(texts, priority)
+
+    def _get_failover_model(self) -> Optional[Tuple[str, object]]:
+        """已加载且通过一致性检查、与API向量可以混用的本地模型(模型名, 模型)；没有时返回None，不会为此加载模型"""
+        if not Config().embedding.failover_enabled:
+            return None
+        identity = self._api_identity()
+        registry = get_model_registry()
+        for model_name, model_info in Config().models.embedding_models.items():
+            if model_info.name != identity or self.vector_store.get_meta(self._parity_key(model_name)) != PARITY_OK:
+                continue
+            model = registry.get_if_loaded(self._model_key(model_name))
+            if model is not None:
+                return model_name, model
+        return None
+
+    def _route_api_embeddings(self, texts: List[str]) -> np.ndarray:
+        """API模式的查询嵌入：API延迟超出预算、限流或请求失败时改用已加载的一致本地模型"""
+        failover_model = self._get_failover_model()
+        if failover_model is None:
+            return self._get_api_embeddings(texts)
+
+        identity = self._api_identity()
+        cached = self.vector_store.get_many(identity, texts)
+        if len(cached) == len(set(texts)):
+            matrix = np.asarray([cached[t] for t in texts], dtype=np.float32)
+            return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+        router = get_failover_router()
+        if router.use_local() or self.rate_limiter.is_saturated():
+            self._probe_api(texts)
+            return self._encode_failover(*failover_model, identity, texts)
+        # 有本地模型兜底时不让API请求无限等待，超时不重试，直接改用本地模型
+        try:
+            return self._get_api_embeddings(texts, timeout=Config().embedding.failover_request_timeout, retries=0)
+        except RuntimeError as e:
+            print(f"{str(e)}\n改用本地模型")
+            return self._encode_failover(*failover_model, identity, texts)
+
+    def _encode_failover(self, model_name: str, model, namespace: str, texts: List[str]) -> np.ndarray:
+        """用本地模型代替API编码，结果写入API模型的向量存储"""
+        def fetch(missing: List[str]) -> np.ndarray:
+            start = time.perf_counter()
+            try:
+                matrix = self._run_local_model(model_name, model, missing, PRIORITY_INTERACTIVE)
+            except Exception:
+                get_failover_router().record(BACKEND_LOCAL, time.perf_counter() - start, False)
+                raise
+            get_failover_router().record(BACKEND_LOCAL, time.perf_counter() - start, True)
+            self._store_local(namespace, missing, matrix)
+            return matrix
+
+        vectors = self._coalesce(namespace, texts, lambda t: self._lookup_local(namespace, t), fetch)
+        return np.stack([vectors[text] for text in texts])
+
+    def _probe_api(self, texts: List[str]) -> None:
+        """降级期间在后台用这次查询的文本请求一次API，只用来记录延迟，不等待结果"""
+        router = get_failover_router()
+        if not router.start_probe():
+            return
+        payload = {"input": list(dict.fromkeys(texts)), "model": self._api_identity(), "encoding_format": "float"}
+
+        def run():
+            try:
+                self._create_embeddings(payload, payload["input"], retries=0)
+            except Exception as e:
+                print(f"探测嵌入API失败: {str(e)}")
+            finally:
+                router.end_probe()
+
+        threading.Thread(target=run, name='embedding-api-probe', daemon=True).start()
+
+    def _get_api_embeddings(self, texts: List[str], priority: int = PRIORITY_INTERACTIVE,
+                            timeout: Optional[float] = None, retries: Optional[int] = None) -> np.ndarray:
+        """先查向量存储，未命中的文本去重后合并为一次API请求，返回归一化后的float32矩阵"""
+        model_name = self._api_identity()
+
+        def lookup(lookup_texts: List[str]) -> Dict[str, np.ndarray]:
+            return {text: vector / np.linalg.norm(vector)
+                    for text, vector in self.vector_store.get_many(model_name, lookup_texts).items()}
+
+        def fetch(missing: List[str]) -> np.ndarray:
             payload = {
-                "input": text,
+                "input": missing,
                 "model": model_name,
                 "encoding_format": "float"  # 指定返回格式
             }
+            if timeout is not None:
+                payload["timeout"] = timeout
+            try:
+                response = self._create_embeddings(payload, missing, priority, retries)
+            except openai.OpenAIError as e:
+                raise RuntimeError(f"API请求失败: {str(e)}\n请求文本数: {len(missing)}")
+            data = sorted(response.data, key=lambda item: item.index)
+            if len(data) != len(missing):
+                raise RuntimeError(f"API返回的嵌入数量({len(data)})与请求的文本数({len(missing)})不一致")
+            for text, item in zip(missing, data):
+                self.vector_store.put(model_name, text, item.embedding)
+            matrix = np.asarray([item.embedding for item in data], dtype=np.float32)
+            return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+        vectors = self._coalesce(model_name, texts, lookup, fetch)
+        return np.stack([vectors[text] for text in texts])
+
+    def _coalesce(self, namespace: str, texts: List[str],
+                  lookup: Callable[[List[str]], Dict[str, np.ndarray]],
+                  fetch: Callable[[List[str]], np.ndarray]) -> Dict[str, np.ndarray]:
+        """查缓存后对未命中的文本请求嵌入，返回{文本: float32归一化向量}
+
+        其他调用方（包括其他会话）正在请求的文本等待其结果，不重复请求；fetch只对本调用方认领的文本调用，
+        返回与传入文本一一对应的归一化向量矩阵，并负责写入缓存。
+        """
+        vectors = lookup(texts)
+        missing = [text for text in dict.fromkeys(texts) if text not in vectors]
+        if not missing:
+            return vectors
+        owned, waiting = self._inflight.claim([(namespace, text) for text in missing])
+        error = None
+        try:
+            owned_texts = [text for _, text in owned]
+            # 认领之前其他调用方可能刚好请求完成并写入了缓存
+            vectors.update(lookup(owned_texts))
+            to_fetch = [text for text in owned_texts if text not in vectors]
+            if to_fetch:
+                vectors.update(zip(to_fetch, fetch(to_fetch)))
+            for key in owned:
+                self._inflight.resolve(key, vectors[key[1]])
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # 包括KeyboardInterrupt等BaseException中断在内，未resolve的键都要结束，否则等待的调用方会一直阻塞；
+            # 已经resolve的键reject时忽略
+            self._inflight.reject(owned, error or RuntimeError("请求嵌入被中断"))
+        for (_, text), call in waiting.items():
+            vectors[text] = call.wait()
+        return vectors
+
+    def get_cached_embeddings(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """只查缓存，返回已缓存文本的归一化向量，未命中的文本不在结果中"""
+        namespace = self.vector_namespace
+        if namespace is None:
+            return {}
+        if self.mode == 'api':
+            cached = self.vector_store.get_many(namespace, texts)
+            return {text: vector / np.linalg.norm(vector) for text, vector in cached.items()}
+        return self._lookup_local(namespace, texts)
 
-            self.cache_lock.acquire()
-            if model_name in self.embedding_cache.keys() and text in self.embedding_cache[model_name].keys():
-                if sys.gettrace() is not None:
-                    print(f'using cache: {model_name} {text}')
-                embedding = self.embedding_cache[model_name][text]
-                self.cache_lock.release()
+    def _lookup_local(self, namespace: str, texts: List[str]) -> Dict[str, np.ndarray]:
+        """依次查内存LRU和向量存储，返回命中的{文本: float32归一化向量}"""
+        vectors = {}
+        missing = []
+        for text in dict.fromkeys(texts):
+            vector = self.query_cache.get((namespace, text))
+            if vector is None:
+                missing.append(text)
             else:
-                # 检查是否指定新的api key，如果指定则更新api key
-                if key is not None and key != self.api_key:
-                    self.api_key = key
-                self.cache_lock.release()
-                try:
-                    response = self.client.embeddings.create(**payload)
-                    embedding = response.data[0].embedding
-                except openai.OpenAIError as e:
-                    raise RuntimeError(f"API请求失败: {str(e)}\n请求参数: {payload}")
-                self.cache_lock.acquire()
-                if model_name not in self.embedding_cache.keys():
-                    self.embedding_cache[model_name] = {}
-                self.embedding_cache[model_name][text] = embedding
-                self.rpm_monitor.append(time.time())
-                self.cache_lock.release()
+                vectors[text] = vector
+        if missing:
+            for text, vector in self.vector_store.get_many(namespace, missing).items():
+                vector = vector / np.linalg.norm(vector)
+                self.query_cache.put((namespace, text), vector)
+                vectors[text] = vector
+        return vectors
+
+    def encode_local_bulk(self, texts: List[str],
+                          batch_size: int) -> Iterator[Tuple[List[str], Optional[np.ndarray], Optional[Exception]]]:
+        """生成缓存用的本地批量编码，每编码完一批就返回(文本列表, 归一化向量矩阵, 异常)
+
+        文本按token长度排序后切成batch_size大小的批，同一批长度相近，padding最少；
+        以批量优先级运行，交互式查询可以插队。已缓存的文本作为第一批直接返回。
+        某一批编码失败时返回(文本列表, None, 异常)并继续编码后面的批次。
+        """
+        model = self._ensure_local_model()
+        namespace = self.vector_namespace
+        texts = list(dict.fromkeys(texts))
+        cached = self._lookup_local(namespace, texts)
+        if cached:
+            yield list(cached.keys()), np.stack(list(cached.values())), None
+
+        missing = [text for text in texts if text not in cached]
+        if not missing:
+            return
+        lengths, exact = self._token_lengths(model, missing)
+        order = np.argsort(lengths, kind='stable')
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            batch = [missing[i] for i in rows]
+            # 按长度升序，最后一个就是这一批的最大长度，只padding到这个长度
+            max_length = int(lengths[rows[-1]]) if exact else None
+            try:
+                vectors = self._coalesce(namespace, batch, lambda t: self._lookup_local(namespace, t),
+                                         self._local_fetcher(model, namespace, PRIORITY_BULK, max_length))
+            except Exception as e:
+                yield batch, None, e
+                continue
+            yield batch, np.stack([vectors[text] for text in batch]), None
+
+    @staticmethod
+    def _token_lengths(model, texts: List[str]) -> Tuple[np.ndarray, bool]:
+        """计算文本的token数；模型没有tokenizer时退化为字符数，第二个返回值表示是否为准确的token数"""
+        tokenizer = getattr(model, 'tokenizer', None)
+        if tokenizer is not None:
+            try:
+                input_ids = tokenizer(texts, add_special_tokens=True)['input_ids']
+                return np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(texts)), True
+            except Exception as e:
+                print(f"计算token长度失败: {str(e)}")
+        return np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts)), False
 
+    def _run_local_model(self, model_name: str, model, texts: List[str], priority: int,
+                         max_length: Optional[int] = None) -> np.ndarray:
+        """调用本地模型编码一批文本，返回归一化后的float32矩阵
 
+        同一模型的推理锁在模型表中所有会话共用，同一时间只做一次推理，交互式查询优先于生成缓存的批量推理。
+        推理进程自己按优先级排队并合并各会话的请求，使用推理进程时不占用推理锁。
+        """
+        kwargs = {}
+        if max_length is not None:
+            kwargs = {'batch_size': len(texts), 'max_length': max_length}
+        if isinstance(model, RemoteModel):
+            kwargs['priority'] = priority
+            hold = nullcontext()
         else:
-            # 本地模式
-            if self.current_model is None:
-                # 如果模型未加载但已下载，尝试加载
-                if self.selected_model and self.is_model_downloaded(self.selected_model):
-                    self._load_local_model(self.selected_model)
-                else:
-                    raise RuntimeError("未加载本地模型")
-            # 每次都重新计算嵌入向量
-            output = self.current_model.encode(
-                text,
+            hold = get_model_registry().get_lock(self._model_key(model_name)).hold(priority)
+        with hold:
+            output = model.encode(
+                texts,
                 return_dense=True,
                 return_sparse=False,
-                return_colbert_vecs=False
+                return_colbert_vecs=False,
+                **kwargs
             )
-            embedding = output['dense_vecs']
+        matrix = np.asarray(output['dense_vecs'], dtype=np.float32).reshape(len(texts), -1)
+        return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    def _store_local(self, namespace: str, texts: List[str], matrix: np.ndarray) -> None:
+        """把新编码的向量写入向量存储和内存LRU，向量存储由后台线程写盘"""
+        for text, vector in zip(texts, matrix):
+            self.vector_store.put(namespace, text, vector)
+            self.query_cache.put((namespace, text), vector)
+
+    def _ensure_local_model(self):
+        """返回当前本地模型；未加载（或已因内存预算被卸载）但已下载时重新加载"""
+        model = self.current_model
+        if model is None:
+            if self.selected_model and self.is_model_downloaded(self.selected_model):
+                model = self._load_local_model(self.selected_model)
+            else:
+                raise RuntimeError("未加载本地模型")
+        return model
+
+    def _encode_local(self, texts: List[str], priority: int = PRIORITY_INTERACTIVE) -> np.ndarray:
+        """本地模型编码，依次查内存LRU和向量存储，只对未命中的文本调用encode，返回归一化后的float32矩阵"""
+        model = self._ensure_local_model()
+        namespace = self.vector_namespace
+        vectors = self._coalesce(namespace, texts, lambda t: self._lookup_local(namespace, t),
+                                 self._local_fetcher(model, namespace, priority))
+        return np.stack([vectors[text] for text in texts])
+
+    def _local_fetcher(self, model, namespace: str, priority: int,
+                       max_length: Optional[int] = None) -> Callable[[List[str]], np.ndarray]:
+        """返回用当前选择的本地模型编码并写入缓存的函数，供_coalesce调用"""
+        model_name = self.selected_model
 
-        # 确保返回新的归一化向量
-        return self.normalize_embedding(embedding.copy() if isinstance(embedding, np.ndarray) else embedding)
\ No newline at end of file
+        def fetch(missing: List[str]) -> np.ndarray:
+            matrix = self._run_local_model(model_name, model, missing, priority, max_length)
+            self._store_local(namespace, missing, matrix)
+            return matrix
+        return fetch
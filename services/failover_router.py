@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from config.settings import Config
+
+"""
+嵌入接口的故障转移
+记录API和本地后端最近若干次请求的延迟和成败。API的p95延迟超过预算或错误率过高时，查询改用与API向量一致的本地模型；
+降级期间定期用一次后台请求探测API，探测结果恢复正常后切回API。
+"""
+
+BACKEND_API = 'api'
+BACKEND_LOCAL = 'local'
+# 样本少于该数时不计算p95和错误率，避免一两次慢请求就触发切换
+_MIN_SAMPLES = 5
+# 降级后API最近几次请求的p95和错误率都低于阈值的该比例时才切回，避免在阈值附近来回切换
+_RECOVER_RATIO = 0.8
+
+
+class BackendHealth:
+    """后端最近window次请求的延迟（秒）和成败"""
+
+    def __init__(self, window: int):
+        self._samples: deque = deque(maxlen=max(window, _MIN_SAMPLES))
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool) -> None:
+        with self._lock:
+            self._samples.append((latency, ok))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._samples.clear()
+
+    def _recent(self, last: Optional[int]) -> list:
+        with self._lock:
+            samples = list(self._samples)
+        return samples[-last:] if last else samples
+
+    def p95(self, last: Optional[int] = None) -> Optional[float]:
+        """最近请求（指定last时为最近last次）延迟的95分位数，样本不足时返回None"""
+        latencies = sorted(latency for latency, _ in self._recent(last))
+        if len(latencies) < _MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self, last: Optional[int] = None) -> Optional[float]:
+        """最近请求（指定last时为最近last次）的失败比例，样本不足时返回None"""
+        samples = self._recent(last)
+        if len(samples) < _MIN_SAMPLES:
+            return None
+        return sum(1 for _, ok in samples if not ok) / len(samples)
+
+
+class FailoverRouter:
+    """决定查询嵌入走API还是本地模型"""
+
+    def __init__(self, latency_budget: float, max_error_rate: float, window: int, probe_interval: float):
+        self._lock = threading.Lock()
+        self.degraded = False
+        self._probing = False
+        self._last_probe = 0.0
+        self.configure(latency_budget, max_error_rate, window, probe_interval)
+
+    def configure(self, latency_budget: float, max_error_rate: float, window: int, probe_interval: float) -> None:
+        with self._lock:
+            self.latency_budget = latency_budget
+            self.max_error_rate = max_error_rate
+            self.window = window
+            self.probe_interval = probe_interval
+            self.health = {BACKEND_API: BackendHealth(window), BACKEND_LOCAL: BackendHealth(window)}
+
+    def _is_unhealthy(self, backend: str, ratio: float = 1.0, last: Optional[int] = None) -> bool:
+        health = self.health[backend]
+        p95 = health.p95(last)
+        error_rate = health.error_rate(last)
+        return ((p95 is not None and p95 > self.latency_budget * ratio) or
+                (error_rate is not None and error_rate > self.max_error_rate * ratio))
+
+    def record(self, backend: str, latency: float, ok: bool) -> None:
+        """记录一次请求，并据此更新API是否降级"""
+        self.health[backend].record(latency, ok)
+        if backend != BACKEND_API:
+            return
+        with self._lock:
+            if not self.degraded and self._is_unhealthy(BACKEND_API):
+                self.degraded = True
+                # 降级后根据最近几次探测请求判断API是否恢复，丢弃降级前的样本
+                self.health[BACKEND_API].clear()
+                print("嵌入API延迟过高或错误过多，查询改用本地模型")
+            elif (self.degraded and self.health[BACKEND_API].p95() is not None and
+                  not self._is_unhealthy(BACKEND_API, _RECOVER_RATIO, _MIN_SAMPLES)):
+                self.degraded = False
+                print("嵌入API已恢复，查询改回使用API")
+
+    def use_local(self) -> bool:
+        """API处于降级状态且本地后端正常时使用本地模型"""
+        with self._lock:
+            return self.degraded and not self._is_unhealthy(BACKEND_LOCAL)
+
+    def start_probe(self) -> bool:
+        """降级期间每probe_interval秒允许一次探测，返回是否应该发起探测"""
+        with self._lock:
+            now = time.monotonic()
+            if not self.degraded or self._probing or now - self._last_probe < self.probe_interval:
+                return False
+            self._probing = True
+            self._last_probe = now
+            return True
+
+    def end_probe(self) -> None:
+        with self._lock:
+            self._probing = False
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_failover_router() -> FailoverRouter:
+    """获取进程内共享的故障转移路由，所有会话共用API的健康状态；配置变化时更新参数"""
+    global _router
+    embedding_config = Config().embedding
+    params = (embedding_config.failover_latency_budget_ms / 1000, embedding_config.failover_max_error_rate,
+              embedding_config.failover_window, embedding_config.failover_probe_interval)
+    with _router_lock:
+        if _router is None:
+            _router = FailoverRouter(*params)
+        elif (_router.latency_budget, _router.max_error_rate, _router.window, _router.probe_interval) != params:
+            _router.configure(*params)
+        return _router
@@ -0,0 +1,102 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import OpenAI
+
+from config.settings import Config
+
+"""
+进程内共享的HTTP客户端
+按(接口地址, api key)复用同一个httpx连接池，嵌入、图片打标和搜索增强的请求都复用保持的连接，
+不需要每次请求重新做TCP和TLS握手。可以在启动时后台预先建立连接。
+这些客户端都在限流器之后使用，SDK本身不重试（max_retries=0），重试由RateLimiter.call发起并计入限流额度。
+"""
+
+_lock = threading.Lock()
+_http_clients: Dict[Tuple[str, Optional[str]], Tuple[tuple, httpx.Client]] = {}
+_openai_clients: Dict[Tuple[str, Optional[str]], Tuple[httpx.Client, OpenAI]] = {}
+_chat_models: Dict[Tuple[str, Optional[str], str], Tuple[httpx.Client, object]] = {}
+_warmed = set()
+
+
+def _http_settings() -> tuple:
+    http_config = Config().http
+    return (http_config.connect_timeout, http_config.read_timeout, http_config.max_connections,
+            http_config.max_keepalive_connections, http_config.keepalive_expiry)
+
+
+def get_http_client(base_url: str, api_key: Optional[str]) -> httpx.Client:
+    """获取(接口地址, api key)对应的连接池，http配置变化时新建"""
+    key = (base_url, api_key)
+    settings = _http_settings()
+    with _lock:
+        cached = _http_clients.get(key)
+        if cached is not None and cached[0] == settings:
+            return cached[1]
+        connect_timeout, read_timeout, max_connections, max_keepalive_connections, keepalive_expiry = settings
+        # 旧的连接池可能仍被其他线程使用，不主动关闭，不再引用后由垃圾回收释放
+        client = httpx.Client(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive_connections,
+                                keepalive_expiry=keepalive_expiry),
+        )
+        _http_clients[key] = (settings, client)
+        return client
+
+
+def get_openai_client(base_url: str, api_key: Optional[str]) -> OpenAI:
+    """获取共享的OpenAI客户端，相同的接口地址和api key返回同一个实例"""
+    http_client = get_http_client(base_url, api_key)
+    key = (base_url, api_key)
+    with _lock:
+        cached = _openai_clients.get(key)
+        if cached is not None and cached[0] is http_client:
+            return cached[1]
+        client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        _openai_clients[key] = (http_client, client)
+        return client
+
+
+def get_chat_model(base_url: str, api_key: Optional[str], model_name: str):
+    """获取共享的ChatOpenAI，与同一接口的OpenAI客户端共用连接池"""
+    from langchain_openai import ChatOpenAI
+
+    http_client = get_http_client(base_url, api_key)
+    key = (base_url, api_key, model_name)
+    with _lock:
+        cached = _chat_models.get(key)
+        if cached is not None and cached[0] is http_client:
+            return cached[1]
+        chat_model = ChatOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            model_name=model_name,
+            http_client=http_client,
+            timeout=Config().http.read_timeout,
+            max_retries=0,
+        )
+        _chat_models[key] = (http_client, chat_model)
+        return chat_model
+
+
+def warm_up(base_url: str, api_key: Optional[str]) -> None:
+    """在后台向接口地址发一个HEAD请求，提前建立连接放入连接池；每个进程每个接口只做一次"""
+    if not base_url or not Config().http.warm_up:
+        return
+    key = (base_url, api_key)
+    with _lock:
+        if key in _warmed:
+            return
+        _warmed.add(key)
+    http_client = get_http_client(base_url, api_key)
+
+    def run():
+        try:
+            # 只为建立连接，响应状态无关紧要
+            http_client.head(base_url)
+        except httpx.HTTPError as e:
+            print(f"预先连接 {base_url} 失败: {str(e)}")
+
+    threading.Thread(target=run, name='http-warm-up', daemon=True).start()
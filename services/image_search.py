@@ -1,20 +1,33 @@
 import os
-import threading
-import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import pickle
 import re
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 
-from config.settings import Config
+from config.settings import Config, get_config_generation
 from pages.utils import ENDWITH_IMAGE
 
 from services.embedding_service import EmbeddingService
+from services.rate_limiter import PRIORITY_BULK
+from services.embedding_index import EmbeddingIndex
+from services.ann_index import IVFIndex, get_ann_file
+from services.quantization import SUPPORTED_INDEX_DTYPES
+from services.lru_cache import LRUCache
+from services.validity_monitor import get_validity_monitor, scan_image_files
+from services.fingerprint import compute_dhash, cluster_fingerprints, CANDIDATE_MAX_DISTANCE
+from services.index_store import (load_columnar, save_columnar, migrate_pickle_cache,
+                                  columns_to_records, records_to_columns, load_cluster_map, save_cluster_map)
 from services.resource_pack_manager import ResourcePackManager
 from services.utils import *
 from services.llm_enhance import LLMEnhance
 
+# search_many每次参与矩阵乘法的查询数量
+SEARCH_MANY_CHUNK_SIZE = 256
+# 生成缓存时每发出多少批嵌入请求保存一次中间缓存
+SAVE_EVERY_BATCHES = 8
+
 
 class ImageSearch:
     def __init__(self, mode: str = 'api', model_name: Optional[str] = None):
@@ -22,73 +35,128 @@ class ImageSearch:
         self.embedding_service.set_mode(mode, model_name)
         self.resource_pack_manager = ResourcePackManager()
         self.llm_enhance = LLMEnhance()
-        self.image_data = None
+        self._services_generation = get_config_generation()
+        self.index: Optional[EmbeddingIndex] = None
+        # 索引版本号，加载缓存（generate_cache、启用/禁用资源包、切换模式都会重新加载）或文件失效时增加
+        self._index_generation = 0
+        self.result_cache = LRUCache(Config().search.result_cache_size, Config().search.result_cache_ttl)
         self._try_load_cache()
+        # 所有会话共用一个扫描线程，每个周期只遍历一次资源包目录
+        get_validity_monitor().subscribe(self, ImageSearch._get_image_dirs, ImageSearch._refresh_validity)
 
     def __reload_class_cache(self):
-        self.embedding_service = EmbeddingService()
-        self.resource_pack_manager = ResourcePackManager()
+        """配置版本号变化时才刷新服务实例，否则直接复用"""
+        generation = get_config_generation()
+        if generation == self._services_generation:
+            return
+        self._services_generation = generation
+        self.embedding_service.refresh_config()
+        self.resource_pack_manager.reload()
+
+    def invalidate_services(self) -> None:
+        """显式标记服务实例失效，下次使用前会重新刷新"""
+        self._services_generation = None
 
     def _try_load_cache(self) -> None:
         self.__reload_class_cache()
         """尝试加载缓存"""
-        # 获取所有启用的资源包的缓存文件
-        cache_files = self.resource_pack_manager.get_cache_files()
-        
-        if not cache_files:
-            self.image_data = None
+        enabled_packs = self.resource_pack_manager.get_enabled_packs()
+        if not enabled_packs:
+            self.index = None
+            self._bump_index_generation()
+            return
+
+        # 以内存映射方式打开每个资源包的列式缓存，旧的pickle缓存先一次性转换
+        segments = []
+        cache_files = {}
+        for pack_id, pack_info in enabled_packs.items():
+            cache_file = self._get_cache_file(pack_id)
+            cache_files[pack_id] = cache_file
+            migrate_pickle_cache(cache_file, pack_id, self._get_pack_path(pack_info),
+                                 self._get_legacy_cache_files(pack_id))
+            loaded = load_columnar(cache_file)
+            if loaded is None:
+                continue
+            embeddings, columns = loaded
+            columns['pack_id'] = [pack_id] * len(columns['filepath'])
+            segments.append((embeddings, columns))
+
+        self.index = EmbeddingIndex.from_columnar(segments)
+        if self.index is not None:
+            self._load_ann_indexes(cache_files)
+            self._quantize_index()
+            # 每个资源包目录遍历一次，代替对每个标签调用os.path.exists；已不存在的图片在索引中标记为失效
+            self._refresh_validity()
+        # 新索引就位后再让旧的搜索结果失效，避免并发的搜索用旧索引的结果填充新版本的缓存
+        self._bump_index_generation()
+
+    def _get_image_dirs(self) -> List[str]:
+        return self.resource_pack_manager.get_all_image_dirs()
+
+    def _refresh_validity(self, existing_paths: Optional[set] = None) -> None:
+        """根据资源包目录的扫描结果更新索引的有效位图，没有传入扫描结果时扫描启用的资源包目录"""
+        index = self.index
+        if index is None:
+            return
+        if existing_paths is None:
+            existing_paths = scan_image_files(self._get_image_dirs())
+        if index.set_validity(existing_paths):
+            self._bump_index_generation()
+
+    @staticmethod
+    def _get_pack_path(pack_info: Dict) -> str:
+        """获取资源包图片目录的绝对路径"""
+        pack_path = pack_info["path"]
+        if not os.path.isabs(pack_path):
+            pack_path = os.path.join(Config().base_dir, pack_path)
+        return pack_path
+
+    def _load_ann_indexes(self, cache_files: Dict[str, str]) -> None:
+        """加载各资源包持久化的ANN索引，过期的索引会被忽略，对应资源包退回精确搜索"""
+        if not Config().search.ann_enabled:
             return
-            
-        # 合并所有缓存文件的数据
-        all_embeddings = []
-        
         for pack_id, cache_file in cache_files.items():
-            if os.path.exists(cache_file):
-                try:
-                    with open(cache_file, 'rb') as f:
-                        cached_data = pickle.load(f)
-                    valid_embeddings = []
-                    for item in cached_data:
-                        # 获取文件路径
-                        if 'filepath' in item:
-                            full_path = item['filepath']
-                        else:
-                            # 使用资源包的路径
-                            pack_info = self.resource_pack_manager.get_enabled_packs().get(pack_id)
-                            if not pack_info:
-                                continue
-                                
-                            pack_path = pack_info["path"]
-                            if not os.path.isabs(pack_path):
-                                pack_path = os.path.join(Config().base_dir, pack_path)
-                                
-                            full_path = os.path.join(pack_path, item['filename'])
-                            # 添加filepath字段
-                            item['filepath'] = full_path
-
-                        if os.path.exists(full_path):
-                            # 添加资源包ID
-                            item['pack_id'] = pack_id
-                            valid_embeddings.append(item)
-
-                    if valid_embeddings:
-                        all_embeddings.extend(valid_embeddings)
-                        # 更新缓存文件
-                        if len(valid_embeddings) != len(cached_data):
-                            with open(cache_file, 'wb') as f:
-                                pickle.dump(valid_embeddings, f)
-                except (pickle.UnpicklingError, EOFError) as e:
-                    print(f"加载缓存文件 {cache_file} 失败: {str(e)}")
-        
-        if all_embeddings:
-            self.image_data = all_embeddings
-        else:
-            self.image_data = None
+            ann = IVFIndex.load(get_ann_file(cache_file))
+            if ann is not None and not self.index.attach_ann(pack_id, ann):
+                print(f"资源包 {pack_id} 的ANN索引已过期，将使用精确搜索")
+
+    def _quantize_index(self) -> None:
+        """按配置压缩索引，全精度矩阵保持内存映射，只在重排时按行读取"""
+        search_config = Config().search
+        if search_config.index_dtype == 'float32':
+            return
+        if search_config.index_dtype not in SUPPORTED_INDEX_DTYPES:
+            print(f"不支持的索引精度 {search_config.index_dtype}，使用float32")
+            return
+        self.index.quantize(search_config.index_dtype, search_config.rerank_candidates)
+
+    def _build_ann_indexes(self) -> None:
+        """为标签数达到阈值的资源包构建ANN索引，并保存在缓存文件旁边
+
+        加载缓存时已挂载的索引与当前嵌入的校验和一致，倒排列表数也符合配置时，说明资源包没有变化，不重新构建。
+        """
+        search_config = Config().search
+        if not search_config.ann_enabled or self.index is None:
+            return
+        for pack_id, (start, end) in self.index.pack_ranges().items():
+            if end - start < search_config.ann_min_size:
+                continue
+            attached = self.index.get_ann(pack_id)
+            n_lists = IVFIndex.resolve_n_lists(end - start, search_config.ann_n_lists)
+            if attached is not None and attached.n_lists == n_lists:
+                continue
+            try:
+                ann = IVFIndex.build(self.index.row_range(start, end), n_lists=search_config.ann_n_lists)
+                ann.save(get_ann_file(self._get_cache_file(pack_id)))
+                self.index.attach_ann(pack_id, ann)
+            except Exception as e:
+                print(f"构建资源包 {pack_id} 的ANN索引失败: {str(e)}")
 
     def _get_cache_file(self, pack_id: str = "default_pack") -> str:
         """获取指定资源包的缓存文件路径"""
-        # 使用ResourcePackManager的方法获取缓存文件路径，传递当前模型名称
-        cache_file = self.resource_pack_manager.get_pack_cache_file(pack_id, self.embedding_service.selected_model)
+        # 使用ResourcePackManager的方法获取缓存文件路径，传递当前模型标识；向量相同的API和本地模式共用同一份缓存
+        cache_tag = self.embedding_service.cache_tag
+        cache_file = self.resource_pack_manager.get_pack_cache_file(pack_id, cache_tag)
         if cache_file:
             return cache_file
             
@@ -96,26 +164,41 @@ class ImageSearch:
         pack_info = self.resource_pack_manager.get_available_packs().get(pack_id)
         if not pack_info:
             # 使用默认缓存文件
-            if self.embedding_service.selected_model:
-                return Config().get_abs_cache_file().replace('.pkl', f'_{self.embedding_service.selected_model}.pkl')
+            if cache_tag:
+                return Config().get_abs_cache_file().replace('.pkl', f'_{cache_tag}.pkl')
             return Config().get_abs_cache_file()
             
         cache_file = pack_info["cache_file"]
         if not os.path.isabs(cache_file):
             cache_file = os.path.join(Config().base_dir, cache_file)
             
-        # 添加模型名称
-        if self.embedding_service.selected_model:
-            cache_file = cache_file.replace('.pkl', f'_{self.embedding_service.selected_model}.pkl')
+        # 添加模型标识
+        if cache_tag:
+            cache_file = cache_file.replace('.pkl', f'_{cache_tag}.pkl')
             
         return cache_file
 
+    def _get_legacy_cache_files(self, pack_id: str) -> List[str]:
+        """旧版本的缓存文件路径：按所选模型名（未选择时为默认模型）命名的缓存，以及不带模型名的缓存"""
+        pack_info = self.resource_pack_manager.get_available_packs().get(pack_id)
+        if not pack_info:
+            return []
+        cache_file = pack_info["cache_file"]
+        if not os.path.isabs(cache_file):
+            cache_file = os.path.join(Config().base_dir, cache_file)
+        legacy_files = []
+        model_name = self.embedding_service.selected_model or Config().models.default_model
+        if model_name:
+            legacy_files.append(cache_file.replace('.pkl', f'_{model_name}.pkl'))
+        legacy_files.append(cache_file)
+        return legacy_files
+
     def set_mode(self, mode: str, model_name: Optional[str] = None) -> None:
         """切换搜索模式和模型"""
         try:
             self.embedding_service.set_mode(mode, model_name)
             # 清空当前缓存
-            self.image_data = None
+            self.index = None
             # 尝试加载新模式/模型的缓存
             self._try_load_cache()
         except Exception as e:
@@ -124,9 +207,8 @@ class ImageSearch:
             if mode == 'local':
                 self.embedding_service.mode = mode
                 self.embedding_service.selected_model = model_name
-                self.embedding_service.current_model = None
             # 确保清空缓存
-            self.image_data = None
+            self.index = None
 
     def download_model(self) -> None:
         """下载选中的模型"""
@@ -138,7 +220,7 @@ class ImageSearch:
 
     def has_cache(self) -> bool:
         """检查是否有可用的缓存"""
-        return self.image_data is not None
+        return self.index is not None
 
     def generate_cache(self, progress_bar) -> None:
         self.__reload_class_cache()
@@ -172,6 +254,8 @@ class ImageSearch:
         # 重新加载所有缓存
         progress_bar.progress(1.0, text="重新加载缓存...")
         self._try_load_cache()
+        progress_bar.progress(1.0, text="构建ANN索引...")
+        self._build_ann_indexes()
         
         # 如果有失败的资源包，报告错误
         if failed_packs:
@@ -193,35 +277,17 @@ class ImageSearch:
         # 确保缓存目录存在
         os.makedirs(os.path.dirname(cache_file), exist_ok=True)
         
-        # 尝试加载现有缓存
+        # 尝试加载现有缓存，旧的pickle缓存先一次性转换
         existing_embeddings = []
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'rb') as f:
-                    loaded_data = pickle.load(f)
-                    
-                # 验证加载的数据格式
-                if isinstance(loaded_data, list):
-                    # 过滤掉不是字典或缺少必要键的元素
-                    valid_embeddings = []
-                    for item in loaded_data:
-                        if isinstance(item, dict) and 'filename' in item and 'embedding' in item:
-                            valid_embeddings.append(item)
-                        else:
-                            print(f"警告: 缓存文件中发现无效的数据项: {type(item)}")
-                    existing_embeddings = valid_embeddings
-                else:
-                    print(f"警告: 缓存文件格式不正确，期望列表但得到 {type(loaded_data)}")
-            except (pickle.UnpicklingError, EOFError) as e:
-                print(f"加载缓存文件 {cache_file} 失败: {str(e)}")
-                existing_embeddings = []
-                
+        migrate_pickle_cache(cache_file, pack_id, img_dir, self._get_legacy_cache_files(pack_id))
+        loaded = load_columnar(cache_file, mmap=False)
+        if loaded is not None:
+            existing_embeddings = columns_to_records(*loaded)
+
         # 确保所有缓存数据都有filepath字段
-        generated_files = []
         for item in existing_embeddings:
             if 'filepath' not in item:
                 item['filepath'] = os.path.join(img_dir, item['filename'])
-            generated_files.append(item['filepath'])
 
         # 获取所有图片文件路径
         def get_all_file_paths(folder_path):
@@ -238,13 +304,14 @@ class ImageSearch:
             if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif'))
         ]
         
-        # 过滤掉已经生成过嵌入的文件
-        new_image_files = [f for f in image_files if f not in generated_files]
-        
-        if not new_image_files and existing_embeddings:
-            # 如果没有新文件且已有缓存，直接返回
-            return
-            
+        # 去掉缓存中已经被删除的图片（搜索时它们只是在有效位图中被标记为失效）
+        image_file_set = set(image_files)
+        kept_embeddings = [item for item in existing_embeddings if item['filepath'] in image_file_set]
+        removed_count = len(existing_embeddings) - len(kept_embeddings)
+        existing_embeddings = kept_embeddings
+        # 旧缓存没有图片指纹时补算
+        backfilled_count = self._backfill_fingerprints(existing_embeddings)
+
         # 获取资源包类型
         image_type = pack_info.get("type", "vv")
         
@@ -252,14 +319,47 @@ class ImageSearch:
         replace_patterns_regex = None
         if "regex" in pack_info:
             replace_patterns_regex = {pack_info["regex"]["pattern"]: pack_info["regex"]["replacement"]}
+
+        # 成员图片被删除，或代表图片已不在缓存中时，丢弃该聚类关系，成员图片重新作为新图片处理
+        indexing_config = Config().indexing
+        stored_cluster_map = load_cluster_map(cache_file)
+        existing_paths = {item['filepath'] for item in existing_embeddings}
+        cluster_map = {member: canonical for member, canonical in (stored_cluster_map or {}).items()
+                       if member in image_file_set and canonical in existing_paths}
+
+        # 过滤掉已经生成过嵌入的文件；标签已经合并到代表图片上的成员图片也视为已生成
+        new_image_files = [f for f in image_files if f not in existing_paths and f not in cluster_map]
+
+        # 计算新图片的指纹，并与已有图片一起做近似重复聚类；还没有聚类表的缓存，已有图片之间也确认一次
+        fingerprints = {item['filepath']: item.get('fingerprint') for item in existing_embeddings}
+        for filepath in new_image_files:
+            fingerprints[filepath] = compute_dhash(filepath)
+        if new_image_files or stored_cluster_map is None:
+            cluster_map.update(self._cluster_near_duplicates(
+                new_image_files, existing_paths, fingerprints, cluster_map,
+                indexing_config.dedup_similarity, stored_cluster_map is None))
+        cluster_changed = cluster_map != stored_cluster_map
+        # 开启去重时每个聚类只索引代表图片，成员图片的标签合并到代表图片上
+        merged_count = 0
+        if indexing_config.dedup_enabled:
+            existing_embeddings, merged_count = self._merge_cluster_members(
+                existing_embeddings, cluster_map, fingerprints)
+
+        if not new_image_files and existing_embeddings:
+            # 如果没有新文件且已有缓存，直接返回
+            if removed_count or backfilled_count or merged_count or cluster_changed:
+                self._save_pack_cache(cache_file, existing_embeddings, cluster_map)
+            return
+
+        # 已经存在的(图片, 标签)不再重复生成嵌入
+        scheduled_labels = {(item['filepath'], item['embedding_name']) for item in existing_embeddings}
             
         # 生成新文件的嵌入
         embeddings = existing_embeddings.copy()
         errors = []
-        
-        # 创建线程列表和线程锁
-        embedding_lock = threading.Lock()
-        
+
+        # 先收集所有待生成的标签，再按批请求嵌入
+        pending_labels = []
         total_files = len(new_image_files)
         for index, filepath in enumerate(new_image_files):
             try:
@@ -275,78 +375,101 @@ class ImageSearch:
                         break
                         
                 if full_filename:
-                    raw_embedding_name = filename
-                    if replace_patterns_regex is not None:
-                        for pattern, replacement in replace_patterns_regex.items():
-                            raw_embedding_name = re.sub(pattern, replacement, raw_embedding_name)
-                            
-                    embedding_names = raw_embedding_name.split('-')
-                    for embedding_name in embedding_names:
-                        if embedding_name == '':
+                    # 开启去重时聚类成员的标签记到代表图片上
+                    target = filepath
+                    if indexing_config.dedup_enabled:
+                        target = cluster_map.get(filepath, filepath)
+                    fingerprint = fingerprints.get(target)
+                    for embedding_name in self._image_labels(filepath, replace_patterns_regex):
+                        if (target, embedding_name) in scheduled_labels:
                             continue
-                            
-                        def add_embedding_thread(embedding_service: EmbeddingService, store_embedding_list: List,
-                                               filename_: str, filepath_: str, embedding_name_: str,
-                                               image_type_: str, pack_id_: str, lock: threading.Lock, errors_list: List):
-                            try:
-                                embedding = embedding_service.get_embedding(embedding_name_)
-                                with lock:
-                                    store_embedding_list.append({
-                                        "filename": filename_,
-                                        "filepath": filepath_,
-                                        "embedding": embedding,
-                                        "embedding_name": embedding_name_,
-                                        "type": image_type_ if image_type_ is not None else 'Normal',
-                                        "pack_id": pack_id_
-                                    })
-                            except Exception as e:
-                                error_msg = f"生成嵌入失败 [{filepath_}]: {str(e)}"
-                                print(error_msg)
-                                with lock:
-                                    errors_list.append(f"[{filepath_}] {str(e)}")
-                                
-                        while self.embedding_service.is_rpm_overload():
-                            print(f"RPM过载，等待1秒...")
-                            time.sleep(1)
-                            
-                        # 创建并启动线程
-                        thread = threading.Thread(
-                            target=add_embedding_thread, 
-                            args=(self.embedding_service, embeddings, filename, filepath, 
-                                  embedding_name, image_type, pack_id, embedding_lock, errors)
-                        )
-                        thread.start()
+                        scheduled_labels.add((target, embedding_name))
+                        pending_labels.append({
+                            "filename": os.path.splitext(os.path.basename(target))[0],
+                            "filepath": target,
+                            "embedding_name": embedding_name,
+                            "type": image_type if image_type is not None else 'Normal',
+                            "pack_id": pack_id,
+                            "fingerprint": fingerprint
+                        })
                         
-                progress_bar.progress((index + 1) / total_files, text=f"处理 {pack_info['name']} 图片 {index + 1}/{total_files}")
+                progress_bar.progress((index + 1) / total_files, text=f"扫描 {pack_info['name']} 图片 {index + 1}/{total_files}")
                 
-
-                if (index % 151 == 0 and index > 0 and
-                        time.time() - self.embedding_service.get_last_request_time() < 30):
-                    # 保存中间缓存
-                    if embeddings:
-                        with embedding_lock:
-                            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-                            with open(cache_file, 'wb') as f:
-                                pickle.dump(embeddings, f)
-                            
-                            self.embedding_service.cache_lock.acquire()
-                            self.embedding_service.save_embedding_cache()
-                            self.embedding_service.cache_lock.release()
-                        
             except Exception as e:
                 print(f"生成嵌入失败 [{filepath}]: {str(e)}")
                 errors.append(f"[{filepath}] {str(e)}")
-                
+
+        # 同一标签文本只请求一次；已在嵌入缓存中的直接使用，其余按batch_size分批请求
+        labels_by_name = {}
+        for record in pending_labels:
+            labels_by_name.setdefault(record["embedding_name"], []).append(record)
+        cached = self.embedding_service.get_cached_embeddings(list(labels_by_name.keys()))
+        for embedding_name, vector in cached.items():
+            for record in labels_by_name.pop(embedding_name):
+                embeddings.append({**record, "embedding": vector})
+        missing_names = list(labels_by_name.keys())
+        local_mode = self.embedding_service.mode == 'local'
+        batch_size = max(1, Config().embedding.local_batch_size if local_mode else Config().embedding.batch_size)
+        total_batches = (len(missing_names) + batch_size - 1) // batch_size
+        completed = 0
+
+        def on_batch_done(batch: List[str], vectors: Optional[np.ndarray]):
+            """一批标签完成后把向量填入使用这些标签的记录，并定期保存中间缓存"""
+            nonlocal completed
+            if vectors is not None:
+                for embedding_name, vector in zip(batch, vectors):
+                    for record in labels_by_name[embedding_name]:
+                        embeddings.append({**record, "embedding": vector})
+            completed += 1
+            progress_bar.progress(min(1.0, completed / total_batches),
+                                  text=f"生成 {pack_info['name']} 标签嵌入 {completed}/{total_batches} 批")
+            if completed % SAVE_EVERY_BATCHES == 0:
+                # 保存中间缓存
+                self._save_pack_cache(cache_file, embeddings, cluster_map)
+                self.embedding_service.save_embedding_cache()
+
+        if local_mode and missing_names:
+            # 本地模式按token长度分桶，长度相近的标签一起编码，每批完成后直接写入记录；某一批失败不影响其他批次
+            try:
+                for batch, vectors, error in self.embedding_service.encode_local_bulk(missing_names, batch_size):
+                    if error is not None:
+                        print(f"生成嵌入失败 [{len(batch)}个标签]: {str(error)}")
+                        errors.append(f"[{', '.join(batch[:5])}...] {str(error)}")
+                    on_batch_done(batch, vectors)
+            except Exception as e:
+                # 模型无法加载等整体失败
+                print(f"生成嵌入失败: {str(e)}")
+                errors.append(str(e))
+        else:
+            batches = [missing_names[i:i + batch_size] for i in range(0, len(missing_names), batch_size)]
+            # 固定大小的线程池处理请求，在途的批次数有上限；结果按提交顺序在当前线程收集
+            concurrency = max(1, Config().embedding.concurrency)
+            in_flight = deque()
+
+            def collect_oldest():
+                batch, future = in_flight.popleft()
+                try:
+                    vectors = future.result()
+                except Exception as e:
+                    print(f"生成嵌入失败 [{len(batch)}个标签]: {str(e)}")
+                    errors.append(f"[{', '.join(batch[:5])}...] {str(e)}")
+                    vectors = None
+                on_batch_done(batch, vectors)
+
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='embedding') as executor:
+                for batch in batches:
+                    # 背压：在途批次达到上限时先等最早提交的一批完成
+                    while len(in_flight) >= concurrency * 2:
+                        collect_oldest()
+                    in_flight.append((batch, executor.submit(self.embedding_service.get_embeddings, batch, None, PRIORITY_BULK)))
+                # 等待所有请求完成后再保存最终缓存
+                while in_flight:
+                    collect_oldest()
+
         # 保存最终缓存
         if embeddings:
-            with embedding_lock:
-                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-                with open(cache_file, 'wb') as f:
-                    pickle.dump(embeddings, f)
-                
-                self.embedding_service.cache_lock.acquire()
-                self.embedding_service.save_embedding_cache()
-                self.embedding_service.cache_lock.release()
+            self._save_pack_cache(cache_file, embeddings, cluster_map)
+            self.embedding_service.save_embedding_cache()
             
         # 提出错误
         if errors:
@@ -354,69 +477,209 @@ class ImageSearch:
             print(error_summary)
             raise RuntimeError(error_summary)
 
-    def _cosine_similarity(self, a: np.ndarray, b: np.ndarray) -> float:
-        """余弦相似度计算"""
-        return np.dot(a, b)
+    @staticmethod
+    def _image_labels(filepath: str, replace_patterns_regex: Optional[Dict[str, str]]) -> List[str]:
+        """由图片文件名得到它的标签：按替换规则处理后以'-'分隔"""
+        raw_embedding_name = os.path.splitext(os.path.basename(filepath))[0]
+        if replace_patterns_regex is not None:
+            for pattern, replacement in replace_patterns_regex.items():
+                raw_embedding_name = re.sub(pattern, replacement, raw_embedding_name)
+        return [embedding_name for embedding_name in raw_embedding_name.split('-') if embedding_name != '']
+
+    @staticmethod
+    def _cluster_near_duplicates(new_image_files: List[str], existing_paths: set,
+                                 fingerprints: Dict[str, Optional[int]], cluster_map: Dict[str, str],
+                                 similarity: float, recheck_existing: bool = False) -> Dict[str, str]:
+        """对新图片和已有图片做近似重复聚类，返回新确定的聚类成员 -> 代表图片
+
+        指纹汉明距离在CANDIDATE_MAX_DISTANCE以内的图片对再用像素级相似度确认，达到similarity才合并。
+        已有图片之间的聚类已经确定，除非recheck_existing否则不再重复确认；代表图片取聚类中路径排序最前的已有图片，
+        没有已有图片时取路径排序最前的新图片。
+        """
+        candidates = sorted(existing_paths) + sorted(new_image_files)
+        n_existing = len(existing_paths)
+        images = {}
+
+        def confirm(i: int, j: int) -> bool:
+            if j < n_existing and not recheck_existing:
+                return False
+            return is_similar_image(candidates[i], candidates[j], similarity, images)
+
+        cluster_ids = cluster_fingerprints([fingerprints.get(path) for path in candidates],
+                                           CANDIDATE_MAX_DISTANCE, confirm)
+        # cluster_fingerprints以聚类中最小的下标作为编号，已有图片排在前面；已有的成员图片换成它的代表图片
+        merged = {}
+        for path, cluster_id in zip(candidates, cluster_ids):
+            canonical = cluster_map.get(candidates[cluster_id], candidates[cluster_id])
+            if canonical != path and path not in cluster_map:
+                merged[path] = canonical
+        return merged
+
+    @staticmethod
+    def _merge_cluster_members(records: List[Dict], cluster_map: Dict[str, str],
+                               fingerprints: Dict[str, Optional[int]]) -> Tuple[List[Dict], int]:
+        """把聚类成员的缓存记录改记到代表图片上，复用已有的嵌入，返回新的记录和改动的记录数"""
+        merged = []
+        seen = set()
+        count = 0
+        for item in records:
+            canonical = cluster_map.get(item['filepath'])
+            if canonical is not None:
+                item = {**item,
+                        "filename": os.path.splitext(os.path.basename(canonical))[0],
+                        "filepath": canonical,
+                        "fingerprint": fingerprints.get(canonical)}
+                count += 1
+            key = (item['filepath'], item['embedding_name'])
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(item)
+        return merged, count
+
+    @staticmethod
+    def _save_pack_cache(cache_file: str, records: List[Dict], cluster_map: Dict[str, str]) -> None:
+        """保存资源包缓存和聚类表，同一聚类的图片分配同一个聚类编号"""
+        cluster_ids = {}
+        for item in records:
+            canonical = cluster_map.get(item['filepath'], item['filepath'])
+            item['cluster_id'] = cluster_ids.setdefault(canonical, len(cluster_ids))
+        save_columnar(cache_file, *records_to_columns(records))
+        save_cluster_map(cache_file, cluster_map)
+
+    @staticmethod
+    def _backfill_fingerprints(records: List[Dict]) -> int:
+        """为缺少指纹的缓存记录补算图片指纹，同一图片只计算一次，返回补算的记录数"""
+        fingerprints = {}
+        count = 0
+        for item in records:
+            if item.get('fingerprint') is not None:
+                continue
+            if item['filepath'] not in fingerprints:
+                fingerprints[item['filepath']] = compute_dhash(item['filepath'])
+            item['fingerprint'] = fingerprints[item['filepath']]
+            if item['fingerprint'] is not None:
+                count += 1
+        return count
 
     def search(self,
                query: str,
                top_k: int = 5,
                api_key: Optional[str] = None,
                use_llm: bool = False) -> List[str]:
-        self.__reload_class_cache()
-        if use_llm:
-            query = self.llm_enhance.search(query)
-
         """语义搜索最匹配的图片"""
+        self.__reload_class_cache()
         if not self.has_cache():
             return []
 
+        # 同一查询在索引未变化时直接返回缓存的结果（Streamlit每次重跑都会重新搜索）
+        cache_key = self._result_cache_key(query, top_k, use_llm)
+        cached = self.result_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+
+        if use_llm:
+            query = self.llm_enhance.search(query)
+
         try:
             query_embedding = self.embedding_service.get_embedding(query, api_key)
         except Exception as e:
             print(f"查询嵌入生成失败: {str(e)}")
             return []
 
-        similarities = []
-        for img in self.image_data:
-            if 'filepath' not in img and Config().misc.adapt_for_old_version:
-                # 使用资源包的路径
-                pack_id = img.get('pack_id', 'default_pack')
-                pack_info = self.resource_pack_manager.get_enabled_packs().get(pack_id)
-                if not pack_info:
-                    continue
-                    
-                pack_path = pack_info["path"]
-                if not os.path.isabs(pack_path):
-                    pack_path = os.path.join(Config().base_dir, pack_path)
-                    
-                img['filepath'] = os.path.join(pack_path, img["filename"])
-                
-            if os.path.exists(img['filepath']):
-                # similarity = self._cosine_similarity(query_embedding, img['embedding'])
-                similarities.append(({
-                                         'path': img['filepath'],
-                                         'embedding_name': img['embedding_name'], },
-                                     self._cosine_similarity(query_embedding, img["embedding"])))
-
-        if not similarities:
+        scores = self.index.score(query_embedding, self._get_n_probe())
+        results = self._rank_scores(scores, top_k, query_embedding)
+        self.result_cache.put(cache_key, tuple(results))
+        return results
+
+    def search_many(self,
+                    queries: List[str],
+                    top_k: int = 5,
+                    api_key: Optional[str] = None,
+                    use_llm: bool = False) -> List[List[str]]:
+        """批量语义搜索，返回与queries一一对应的结果列表"""
+        self.__reload_class_cache()
+        if not queries:
             return []
+        if not self.has_cache():
+            return [[] for _ in queries]
+
+        # 命中结果缓存的查询直接返回，其余查询一起计算
+        cache_keys = [self._result_cache_key(query, top_k, use_llm) for query in queries]
+        results = []
+        for cache_key in cache_keys:
+            cached = self.result_cache.get(cache_key)
+            results.append(list(cached) if cached is not None else None)
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+
+        pending_queries = [queries[i] for i in pending]
+        if use_llm:
+            pending_queries = [self.llm_enhance.search(query) for query in pending_queries]
 
-        exists_imgs_path = []
-        # 按相似度降序排序并返回前top_k个结果
-        sorted_items = sorted(similarities, key=lambda x: x[1], reverse=True)
-        return_list = []
-        count = 0
-        for i in sorted_items:
-            if count >= top_k * 5:
-                break
-            if i[0]['path'] not in exists_imgs_path:
-                return_list.append(i[0])
-                exists_imgs_path.append(i[0]['path'])
-                count += 1
-
-        # 随机化输出 去除重复图片
-
+        try:
+            query_embeddings = self.embedding_service.get_embeddings(pending_queries, api_key)
+        except Exception as e:
+            print(f"查询嵌入生成失败: {str(e)}")
+            return [result if result is not None else [] for result in results]
+
+        # 分块做矩阵乘法，避免查询数和标签数都很大时相似度矩阵占用过多内存
+        for start in range(0, len(pending), SEARCH_MANY_CHUNK_SIZE):
+            chunk_scores = self.index.score_many(query_embeddings[start:start + SEARCH_MANY_CHUNK_SIZE])
+            for offset, scores in enumerate(chunk_scores):
+                i = pending[start + offset]
+                results[i] = self._rank_scores(scores, top_k, query_embeddings[start + offset])
+                self.result_cache.put(cache_keys[i], tuple(results[i]))
+        return results
+
+    def _result_cache_key(self, query: str, top_k: int, use_llm: bool) -> tuple:
+        """结果缓存的键：规范化后的查询、结果数量、启用的资源包、模式和模型、是否启用llm增强、索引版本号"""
+        normalized_query = ' '.join(query.split()).lower()
+        return (normalized_query, top_k,
+                frozenset(self.resource_pack_manager.get_enabled_packs().keys()),
+                self.embedding_service.mode, self.embedding_service.selected_model,
+                use_llm, self._index_generation)
+
+    def _bump_index_generation(self) -> None:
+        """索引发生变化，之前缓存的搜索结果全部失效"""
+        self._index_generation += 1
+        self.result_cache.clear()
+
+    def _get_n_probe(self) -> Optional[int]:
+        """索引规模达到阈值时返回ANN的探测列表数，否则返回None表示精确搜索"""
+        search_config = Config().search
+        if not search_config.ann_enabled or self.index.n_labels < search_config.ann_min_size:
+            return None
+        return search_config.ann_n_probe
+
+    def _rank_scores(self, scores: np.ndarray, top_k: int, query_embedding: np.ndarray) -> List[str]:
+        """根据每张图片的相似度得到最终的图片列表"""
+        # 索引中每张图片只有一个相似度，前k个就是不重复的图片；
+        # 同一近似重复聚类只保留相似度最高的一张，聚类在生成缓存时已经用像素级相似度确认，搜索时不读取图片
+        indices, _ = EmbeddingIndex.select_top_k(scores, top_k * 5)
+        if len(indices) == 0:
+            return []
+        seen_clusters = set()
+        kept = []
+        for i in indices:
+            cluster = (self.index.pack_ids[i], int(self.index.cluster_ids[i]))
+            if cluster[1] >= 0:
+                if cluster in seen_clusters:
+                    continue
+                seen_clusters.add(cluster)
+            kept.append(i)
+        indices = np.asarray(kept, dtype=np.int64)
+
+        embedding_names = self.index.best_labels(query_embedding, indices)
+        return_list = [{
+            'path': self.index.filepaths[i],
+            'embedding_name': embedding_name,
+        } for i, embedding_name in zip(indices, embedding_names)]
+        return self._randomize_results(return_list, top_k)
+
+    def _randomize_results(self, return_list: List[Dict], top_k: int) -> List[str]:
+        """随机化输出"""
         skip_indexes = []
         return_list_2 = []
         for index, i in enumerate(return_list):
@@ -431,20 +694,15 @@ class ImageSearch:
                     skip_indexes.append(index + jndex + 1)
             if len(randomize_list) >= 2:
                 random.shuffle(randomize_list)
-                return_list_2 += [i['path'] for i in pop_similar_images(randomize_list)]
+                return_list_2 += [i['path'] for i in randomize_list]
             else:
                 return_list_2.append(i['path'])
 
         return return_list_2
-        # # 按相似度排序
-        # similarities.sort(reverse=True)
-        #
-        # # 返回前top_k个结果
-        # return [item[1] for item in similarities[:top_k]]
         
     def reload_resource_packs(self) -> None:
         """重新加载资源包"""
-        self.resource_pack_manager = ResourcePackManager()
+        self.invalidate_services()
         self._try_load_cache()
         
     def enable_resource_pack(self, pack_id: str) -> bool:
@@ -474,20 +732,16 @@ class ImageSearch:
         return self.resource_pack_manager.get_pack_cover(pack_id)
 
 
-def pop_similar_images(input_image_list, threshold=0.9):
-    return_images = []
-    image_list = []
-    for index, i in enumerate(input_image_list):
-        c = i.copy()
-        c['image'] = load_image(i['path'])
-        image_list.append(c)
-    for index, img in enumerate(image_list):
-
-        max_similar = 0
-        logger.trace(index)
-        for j in image_list[index+1:]:
-            max_similar = max(max_similar, calculate_image_similarity(img['image'], j['image']))
-        if max_similar < threshold:
-            return_images.append(img)
+def is_similar_image(path_a: str, path_b: str, threshold: float, images: Optional[Dict] = None) -> bool:
+    """用像素级相似度（TM_CCORR_NORMED）确认两张图片是否相似，images缓存已读取的图片，读取失败视为不相似"""
+    if images is None:
+        images = {}
+    try:
+        for path in (path_a, path_b):
+            if path not in images:
+                images[path] = load_image(path)
+        return calculate_image_similarity(images[path_a], images[path_b]) >= threshold
+    except Exception as e:
+        print(f"比较图片相似度失败 [{path_a}, {path_b}]: {str(e)}")
+        return False
 
-    return return_images
\ No newline at end of file
@@ -0,0 +1,238 @@
+import json
+import os
+import pickle
+import uuid
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+"""
+列式缓存格式
+<缓存名>.<版本>.npy  float32嵌入矩阵，每一行是资源包中一个不重复的标签，加载时以内存映射方式打开，不需要反序列化
+<缓存名>.meta.json   元数据：matrix_version为对应矩阵文件名中的版本；labels为与矩阵行一一对应的标签文本；
+                     columns中每一列是与图片一一对应的列表；
+                     图片到标签的映射以CSR形式保存，第i张图片的标签行号为label_ids[indptr[i]:indptr[i+1]]
+同一标签文本被多张图片使用时只保存和打分一次。
+每次保存都写入新版本的矩阵文件，不覆盖可能正被其他会话内存映射的旧矩阵（Windows下无法替换被映射的文件）；
+meta.json最后写入，指向新矩阵后才算写入完成，中途失败时旧的元数据仍然指向旧矩阵。
+加载后的元数据columns包含图片列以及labels、indptr、label_ids三项。
+"""
+
+FORMAT_VERSION = 1
+IMAGE_COLUMNS = ('filename', 'filepath', 'type', 'pack_id')
+# 可选列，旧缓存中可能不存在；fingerprint为图片的64位dHash，无法计算时为null；
+# cluster_id为资源包内近似重复图片聚类的编号，同一聚类的图片编号相同；开启去重时每个聚类只剩代表图片
+OPTIONAL_COLUMNS = ('fingerprint', 'cluster_id')
+_COLUMN_DEFAULTS = {'filename': '', 'type': 'Normal', 'pack_id': 'default_pack', 'fingerprint': None, 'cluster_id': None}
+
+
+def get_meta_file(cache_file: str) -> str:
+    """根据原来的.pkl缓存路径得到列式缓存的元数据文件路径"""
+    return os.path.splitext(cache_file)[0] + '.meta.json'
+
+
+def get_matrix_file(cache_file: str, matrix_version: str) -> str:
+    """列式缓存中某一版本的矩阵文件路径"""
+    return f'{os.path.splitext(cache_file)[0]}.{matrix_version}.npy'
+
+
+def columnar_cache_exists(cache_file: str) -> bool:
+    """检查列式缓存是否存在"""
+    return os.path.exists(get_meta_file(cache_file))
+
+
+def save_columnar(cache_file: str, embeddings: np.ndarray, columns: Dict[str, List]) -> None:
+    """保存列式缓存：先写新版本的矩阵文件，再替换元数据，最后删除不再使用的旧矩阵"""
+    meta_path = get_meta_file(cache_file)
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if embeddings.ndim != 2:
+        embeddings = embeddings.reshape(len(columns['labels']), -1)
+
+    matrix_version = uuid.uuid4().hex[:12]
+    npy_path = get_matrix_file(cache_file, matrix_version)
+    tmp_npy = npy_path + '.tmp'
+    with open(tmp_npy, 'wb') as f:
+        np.save(f, embeddings)
+    os.replace(tmp_npy, npy_path)
+
+    meta = {
+        'version': FORMAT_VERSION,
+        'matrix_version': matrix_version,
+        'count': int(embeddings.shape[0]),
+        'dim': int(embeddings.shape[1]) if embeddings.shape[0] else 0,
+        'labels': list(columns['labels']),
+        'indptr': [int(i) for i in columns['indptr']],
+        'label_ids': [int(i) for i in columns['label_ids']],
+        'columns': {name: list(columns[name]) for name in IMAGE_COLUMNS + OPTIONAL_COLUMNS if name in columns},
+    }
+    tmp_meta = meta_path + '.tmp'
+    with open(tmp_meta, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_meta, meta_path)
+    _remove_stale_matrices(cache_file, npy_path)
+
+
+def _remove_stale_matrices(cache_file: str, current_path: str) -> None:
+    """删除元数据不再指向的矩阵文件；仍被内存映射、暂时无法删除的留到下次保存时再删"""
+    directory = os.path.dirname(current_path)
+    prefix = os.path.basename(os.path.splitext(cache_file)[0]) + '.'
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.startswith(prefix) or not name.endswith('.npy') or path == current_path:
+            continue
+        if '.' in name[len(prefix):-len('.npy')]:
+            # 名字中还有其他点号的是别的缓存的文件
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def load_columnar(cache_file: str, mmap: bool = True) -> Optional[Tuple[np.ndarray, Dict[str, List]]]:
+    """加载列式缓存，返回(标签嵌入矩阵, 元数据)；不存在、版本不符或损坏时返回None"""
+    if not columnar_cache_exists(cache_file):
+        return None
+    meta_path = get_meta_file(cache_file)
+    npy_path = meta_path
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != FORMAT_VERSION:
+            print(f"缓存 {meta_path} 版本不符: {meta.get('version')}")
+            return None
+        # 矩阵文件由元数据中的版本确定，元数据和矩阵总是同一次保存写入的
+        npy_path = get_matrix_file(cache_file, meta['matrix_version'])
+        embeddings = np.load(npy_path, mmap_mode='r' if mmap else None)
+        if embeddings.shape[0] != meta['count'] or len(meta['labels']) != meta['count']:
+            print(f"缓存 {npy_path} 行数与元数据不一致")
+            return None
+        columns = dict(meta['columns'])
+        columns['labels'] = meta['labels']
+        columns['indptr'] = np.asarray(meta['indptr'], dtype=np.int64)
+        columns['label_ids'] = np.asarray(meta['label_ids'], dtype=np.int64)
+        if len(columns['indptr']) != len(columns['filepath']) + 1:
+            print(f"缓存 {meta_path} 图片数与标签映射不一致")
+            return None
+        return embeddings, columns
+    except (OSError, ValueError, KeyError) as e:
+        print(f"加载缓存 {npy_path} 失败: {str(e)}")
+        return None
+
+
+def records_to_columns(records: List[Dict]) -> Tuple[np.ndarray, Dict[str, List]]:
+    """把每个(图片, 标签)一条的字典列表转换为(标签嵌入矩阵, 元数据)
+
+    相同的标签文本只保留第一次出现的向量，同一图片的记录合并为一张图片。
+    """
+    label_rows: Dict[str, int] = {}
+    vectors = []
+    image_rows: Dict[str, int] = {}
+    image_labels: List[List[int]] = []
+    columns = {name: [] for name in IMAGE_COLUMNS + OPTIONAL_COLUMNS}
+    for item in records:
+        label = item.get('embedding_name', '')
+        label_id = label_rows.get(label)
+        if label_id is None:
+            label_id = label_rows[label] = len(vectors)
+            vectors.append(np.asarray(item['embedding'], dtype=np.float32))
+        image = image_rows.get(item['filepath'])
+        if image is None:
+            image = image_rows[item['filepath']] = len(image_labels)
+            image_labels.append([])
+            for name in columns:
+                columns[name].append(item['filepath'] if name == 'filepath' else item.get(name, _COLUMN_DEFAULTS[name]))
+        if label_id not in image_labels[image]:
+            image_labels[image].append(label_id)
+
+    embeddings = np.asarray(vectors, dtype=np.float32) if vectors else np.empty((0, 0), dtype=np.float32)
+    indptr = np.zeros(len(image_labels) + 1, dtype=np.int64)
+    np.cumsum([len(labels) for labels in image_labels], out=indptr[1:])
+    columns['labels'] = list(label_rows.keys())
+    columns['indptr'] = indptr
+    columns['label_ids'] = np.fromiter((i for labels in image_labels for i in labels), dtype=np.int64,
+                                       count=int(indptr[-1]))
+    return embeddings, columns
+
+
+def get_cluster_map_file(cache_file: str) -> str:
+    """近似重复聚类表保存在缓存文件旁边"""
+    return os.path.splitext(cache_file)[0] + '.clusters.json'
+
+
+def load_cluster_map(cache_file: str) -> Optional[Dict[str, str]]:
+    """加载聚类表：近似重复聚类的成员图片路径 -> 其聚类代表图片路径，还没有聚类表时返回None"""
+    path = get_cluster_map_file(cache_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"加载聚类表 {path} 失败: {str(e)}")
+        return None
+
+
+def save_cluster_map(cache_file: str, cluster_map: Dict[str, str]) -> None:
+    """保存聚类表"""
+    path = get_cluster_map_file(cache_file)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cluster_map, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def columns_to_records(embeddings: np.ndarray, columns: Dict[str, List]) -> List[Dict]:
+    """把列式缓存还原为每个(图片, 标签)一条的字典列表，用于增量生成缓存"""
+    records = []
+    labels = columns['labels']
+    indptr = columns['indptr']
+    label_ids = columns['label_ids']
+    for image in range(len(columns['filepath'])):
+        image_record = {name: columns[name][image] for name in IMAGE_COLUMNS + OPTIONAL_COLUMNS if name in columns}
+        for label_id in label_ids[indptr[image]:indptr[image + 1]]:
+            record = dict(image_record)
+            record['embedding_name'] = labels[label_id]
+            record['embedding'] = np.asarray(embeddings[label_id], dtype=np.float32)
+            records.append(record)
+    return records
+
+
+def migrate_pickle_cache(cache_file: str, pack_id: str, pack_path: str, legacy_files: Sequence[str] = ()) -> bool:
+    """把旧的pickle缓存一次性转换为列式缓存
+
+    cache_file本身的pickle转换成功后重命名为.pkl.migrated；不存在时依次尝试legacy_files中旧版本命名的pickle，
+    旧文件名的缓存不属于某一个模型标识，转换后保留原文件。
+    """
+    if columnar_cache_exists(cache_file):
+        return False
+    source = next((path for path in (cache_file, *legacy_files) if os.path.exists(path)), None)
+    if source is None:
+        return False
+    try:
+        with open(source, 'rb') as f:
+            cached_data = pickle.load(f)
+    except (pickle.UnpicklingError, EOFError) as e:
+        print(f"加载缓存文件 {source} 失败: {str(e)}")
+        return False
+    if not isinstance(cached_data, list):
+        print(f"警告: 缓存文件格式不正确，期望列表但得到 {type(cached_data)}")
+        return False
+
+    records = []
+    for item in cached_data:
+        if not isinstance(item, dict) or 'filename' not in item or 'embedding' not in item:
+            continue
+        if 'filepath' not in item:
+            item['filepath'] = os.path.join(pack_path, item['filename'])
+        item['pack_id'] = pack_id
+        records.append(item)
+    if not records:
+        return False
+
+    save_columnar(cache_file, *records_to_columns(records))
+    if source == cache_file:
+        os.replace(cache_file, cache_file + '.migrated')
+    print(f"缓存 {source} 已转换为列式格式 {cache_file}")
+    return True
@@ -0,0 +1,271 @@
+import itertools
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config.settings import Config
+from services.model_registry import get_model_registry, estimate_disk_size
+from services.rate_limiter import PRIORITY_INTERACTIVE, PRIORITY_BULK
+
+"""
+本地嵌入模型的推理进程
+每个Streamlit会话都有自己的EmbeddingService，直接加载模型时每个会话各持有一份权重，推理也在会话线程里和页面争抢GIL。
+开启embedding.inference_worker后，模型只在推理进程中加载一次，各会话通过本机的multiprocessing.connection发送请求；
+推理进程把短时间内到达的请求合并成一批推理，再把结果分别返回；交互式查询排在生成缓存的批量请求之前。
+推理进程以`python -m services.inference_worker`启动，不会重新执行Streamlit的入口脚本。
+"""
+
+# 项目根目录，推理进程在这里启动以便导入services包
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _EncodeRequest:
+    def __init__(self, model_name: str, texts: List[str], max_length: Optional[int]):
+        self.model_name = model_name
+        self.texts = texts
+        self.max_length = max_length
+        self.reply = None
+        self.done = threading.Event()
+
+
+class InferenceWorker:
+    """推理进程的服务端：每个连接一个线程接收请求，由一个批处理线程按优先级合并请求后推理"""
+
+    def __init__(self, authkey: bytes, max_batch_size: int, max_wait: float):
+        self.listener = Listener(('127.0.0.1', 0), authkey=authkey)
+        self.address = self.listener.address
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # (优先级, 到达顺序, 请求)，同一优先级先到先处理
+        self._requests: queue.PriorityQueue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+
+    def serve_forever(self) -> None:
+        threading.Thread(target=self._batch_loop, name='inference-batch', daemon=True).start()
+        while True:
+            conn = self.listener.accept()
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _get_model(model_name: str):
+        """推理进程中的模型同样由模型表管理，受内存预算限制"""
+        from services.embedding_service import load_local_model
+
+        model_path = Config().get_model_path(model_name)
+        if not os.path.exists(model_path):
+            raise RuntimeError(f"模型 {model_name} 尚未下载")
+
+        def loader():
+            print(f"推理进程正在加载模型 {model_name}...")
+            return load_local_model(model_path)
+
+        return get_model_registry().get(model_name, loader, estimate_disk_size(model_path), model_path)
+
+    def _handle_connection(self, conn) -> None:
+        try:
+            while True:
+                op, model_name, texts, max_length, priority = conn.recv()
+                if op == 'load':
+                    try:
+                        self._get_model(model_name)
+                        reply = ('ok', None)
+                    except Exception as e:
+                        reply = ('error', str(e))
+                elif op == 'tokenize':
+                    try:
+                        input_ids = self._get_model(model_name).tokenizer(texts, add_special_tokens=True)['input_ids']
+                        reply = ('ok', [list(ids) for ids in input_ids])
+                    except Exception as e:
+                        reply = ('error', str(e))
+                else:
+                    request = _EncodeRequest(model_name, texts, max_length)
+                    self._requests.put((priority, next(self._sequence), request))
+                    request.done.wait()
+                    reply = request.reply
+                conn.send(reply)
+        except (EOFError, OSError):
+            conn.close()
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = [self._requests.get()[2]]
+            n_texts = len(batch[0].texts)
+            deadline = time.monotonic() + self.max_wait
+            # 等待一小段时间，把同时到达的请求合并成一批
+            while n_texts < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    _, _, request = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_texts += len(request.texts)
+
+            by_model: Dict[str, List[_EncodeRequest]] = {}
+            for request in batch:
+                by_model.setdefault(request.model_name, []).append(request)
+            for model_name, requests in by_model.items():
+                self._encode_group(model_name, requests)
+
+    def _encode_group(self, model_name: str, requests: List[_EncodeRequest]) -> None:
+        texts = [text for request in requests for text in request.texts]
+        max_lengths = [request.max_length for request in requests]
+        kwargs = {}
+        if None not in max_lengths:
+            kwargs = {'batch_size': len(texts), 'max_length': max(max_lengths)}
+        try:
+            output = self._get_model(model_name).encode(
+                texts,
+                return_dense=True,
+                return_sparse=False,
+                return_colbert_vecs=False,
+                **kwargs
+            )
+            dense = np.asarray(output['dense_vecs'], dtype=np.float32).reshape(len(texts), -1)
+            start = 0
+            for request in requests:
+                request.reply = ('ok', dense[start:start + len(request.texts)])
+                start += len(request.texts)
+        except Exception as e:
+            for request in requests:
+                request.reply = ('error', str(e))
+        for request in requests:
+            request.done.set()
+
+
+def main() -> None:
+    """推理进程入口：从标准输入读取authkey，把监听地址写到标准输出后开始服务
+
+    标准输入在父进程退出时关闭，推理进程随之退出。
+    """
+    authkey = bytes.fromhex(sys.stdin.readline().strip())
+    embedding_config = Config().embedding
+    worker = InferenceWorker(authkey, embedding_config.worker_max_batch_size,
+                             embedding_config.worker_max_wait_ms / 1000)
+    host, port = worker.address
+    print(f"{host} {port}", flush=True)
+    # 之后的输出（加载模型的日志等）转到标准错误，父进程不再读取标准输出
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def watch_parent():
+        sys.stdin.read()
+        os._exit(0)
+
+    threading.Thread(target=watch_parent, name='inference-parent-watch', daemon=True).start()
+    worker.serve_forever()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker_address() -> Tuple[Tuple[str, int], bytes]:
+    """返回推理进程的(地址, authkey)，进程不存在或已退出时启动一个"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or _worker[0].poll() is not None:
+            authkey = os.urandom(16)
+            process = subprocess.Popen([sys.executable, '-m', 'services.inference_worker'],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=_PROJECT_ROOT)
+            process.stdin.write(authkey.hex().encode() + b'\n')
+            process.stdin.flush()
+            # 标准输入保持打开，父进程退出时推理进程才能察觉；Windows的管道不支持select，在线程中读取地址
+            lines = []
+            reader = threading.Thread(target=lambda: lines.append(process.stdout.readline()), daemon=True)
+            reader.start()
+            reader.join(60)
+            if not lines or not lines[0].strip():
+                process.kill()
+                raise RuntimeError("推理进程启动失败或超时")
+            process.stdout.close()
+            host, port = lines[0].decode().split()
+            _worker = (process, (host, int(port)), authkey)
+        return _worker[1], _worker[2]
+
+
+class _RemoteTokenizer:
+    """推理进程中模型tokenizer的代理，只支持批量计算input_ids"""
+
+    def __init__(self, model: 'RemoteModel'):
+        self._model = model
+
+    def __call__(self, texts: List[str], add_special_tokens: bool = True) -> Dict[str, List[List[int]]]:
+        return {'input_ids': self._model._request(
+            ('tokenize', self._model.model_name, list(texts), None, PRIORITY_INTERACTIVE))}
+
+
+class RemoteModel:
+    """推理进程中模型的代理，encode的参数和返回值与BGEM3FlagModel一致"""
+
+    # 权重在推理进程中，代理本身不占用模型内存
+    resident_size = 0
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.tokenizer = _RemoteTokenizer(self)
+        # 空闲的连接，每个请求独占一个连接，不同线程的请求可以同时进行
+        self._connections: queue.LifoQueue = queue.LifoQueue()
+
+    def _drain_connections(self) -> None:
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn = self._connections.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _request(self, message: tuple):
+        # 推理进程重启后连接池中的旧连接全部失效，一次失败后清空连接池，用新建的连接重试一次
+        for attempt in range(2):
+            address, authkey = get_worker_address()
+            conn = None
+            try:
+                try:
+                    conn = self._connections.get_nowait()
+                except queue.Empty:
+                    conn = Client(address, authkey=authkey)
+                conn.send(message)
+                status, payload = conn.recv()
+            except (EOFError, OSError) as e:
+                if conn is not None:
+                    conn.close()
+                if attempt == 1:
+                    raise RuntimeError(f"与推理进程通信失败: {str(e)}")
+                self._drain_connections()
+                continue
+            self._connections.put(conn)
+            if status != 'ok':
+                raise RuntimeError(f"推理进程执行失败: {payload}")
+            return payload
+
+    def load(self) -> None:
+        """让推理进程加载模型，已加载时直接返回"""
+        self._request(('load', self.model_name, None, None, PRIORITY_BULK))
+
+    def encode(self, sentences, batch_size: Optional[int] = None, max_length: Optional[int] = None,
+               return_dense: bool = True, return_sparse: bool = False, return_colbert_vecs: bool = False,
+               priority: int = PRIORITY_INTERACTIVE):
+        """priority决定请求在推理进程队列中的顺序"""
+        if return_sparse or return_colbert_vecs:
+            raise ValueError("推理进程只支持稠密向量")
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        dense = self._request(('encode', self.model_name, texts, max_length, priority))
+        return {'dense_vecs': dense[0] if single else dense}
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,8 @@ import cv2
 from PIL import Image, ImageEnhance
 import io
 import openai
-from openai import OpenAI
+from services.rate_limiter import get_rate_limiter, estimate_tokens
+from services.http_clients import get_openai_client, warm_up
 
 PROMOTE = """你是一位表情包分类专家。请分析这个表情包，要求：
 
@@ -18,6 +19,7 @@ class LabelMemes():
     def __init__(self):
         self.api_key = Config().api.vlm_models.api_key
         self.base_url = Config().api.vlm_models.base_url
+        warm_up(self.base_url, self.api_key)
         self.cache = {}
         self.use_cache = False
         self._load_cache()
@@ -192,8 +194,10 @@ class LabelMemes():
         '''
 
         try:
-            client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-            response = client.chat.completions.create(**payload)
+            client = get_openai_client(self.base_url, self.api_key)
+            # 图片按约1500个token估计，加上提示词和输出上限
+            response = get_rate_limiter('vlm').call(lambda: client.chat.completions.create(**payload),
+                                                    tokens=1500 + estimate_tokens(PROMOTE) + payload['max_tokens'])
             description = response.choices[0].message.content
             
             # 缓存结果
@@ -0,0 +1,153 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional
+
+from config.settings import Config
+from services.rate_limiter import PriorityLock
+
+# 估算模型占用内存时统计的权重文件
+WEIGHT_EXTENSIONS = ('.bin', '.safetensors', '.pt', '.onnx')
+
+
+def estimate_model_size(model, model_path: Optional[str] = None) -> int:
+    """估算已加载模型占用的内存（字节）
+
+    模型自己提供resident_size时直接使用（ONNX模型为模型文件大小，推理进程的代理为0）；
+    PyTorch模型统计参数和缓冲区的实际大小；都没有时按权重文件大小估算。
+    """
+    size = getattr(model, 'resident_size', None)
+    if size is not None:
+        return int(size)
+    module = getattr(model, 'model', None)
+    if module is not None and hasattr(module, 'parameters'):
+        size = sum(p.numel() * p.element_size() for p in module.parameters())
+        size += sum(b.numel() * b.element_size() for b in module.buffers())
+        return int(size)
+    return estimate_disk_size(model_path) if model_path else 0
+
+
+def estimate_disk_size(model_path: str) -> int:
+    """模型目录中权重文件的大小，加载前用来估计需要的内存；只统计顶层目录，不含导出的onnx"""
+    if not os.path.isdir(model_path):
+        return 0
+    return sum(os.path.getsize(os.path.join(model_path, name)) for name in os.listdir(model_path)
+               if name.endswith(WEIGHT_EXTENSIONS) and os.path.isfile(os.path.join(model_path, name)))
+
+
+class ModelRegistry:
+    """进程内共享的已加载模型表，总占用超过内存预算时淘汰最久未使用的模型
+
+    budget_bytes为0表示不限制。单个模型超过预算时淘汰其他所有模型后仍然加载。
+    会话不长期持有模型的引用，每次使用时从这里获取，淘汰后模型在正在进行的推理结束时即可释放。
+    """
+
+    def __init__(self, budget_bytes: int = 0):
+        self.budget_bytes = budget_bytes
+        self._models: OrderedDict = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._loading: Dict[Hashable, threading.Event] = {}
+        # 每个模型一把推理锁，所有会话共用，交互式查询优先于批量编码
+        self._encode_locks: Dict[Hashable, PriorityLock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, loader: Callable[[], object], expected_size: int = 0,
+            model_path: Optional[str] = None):
+        """获取模型，未加载时调用loader加载；同一模型同时只会加载一次"""
+        while True:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+                event = self._loading.get(key)
+                if event is None:
+                    event = self._loading[key] = threading.Event()
+                    # 先腾出预计需要的空间，避免新旧模型同时驻留超出预算
+                    self._evict(expected_size)
+                    break
+            # 其他线程（比如后台预加载）正在加载，等待完成后再取
+            event.wait()
+
+        try:
+            model = loader()
+            size = estimate_model_size(model, model_path)
+            with self._lock:
+                self._models[key] = model
+                self._sizes[key] = size
+                self._evict(0, keep=key)
+            return model
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    def _evict(self, incoming: int, keep: Optional[Hashable] = None) -> None:
+        if self.budget_bytes <= 0:
+            return
+        while self._models and sum(self._sizes.values()) + incoming > self.budget_bytes:
+            key = next(iter(self._models))
+            if key == keep:
+                if len(self._models) == 1:
+                    return
+                self._models.move_to_end(key)
+                continue
+            del self._models[key]
+            size = self._sizes.pop(key, 0)
+            print(f"内存超出预算，卸载模型 {key}（{size / 1024 ** 2:.0f}MB）")
+
+    def get_if_loaded(self, key: Hashable):
+        """模型已驻留时返回模型，否则返回None，不会触发加载"""
+        with self._lock:
+            if key not in self._models:
+                return None
+            self._models.move_to_end(key)
+            return self._models[key]
+
+    def get_lock(self, key: Hashable) -> PriorityLock:
+        """模型的推理锁，同一模型同一时间只做一次推理"""
+        with self._lock:
+            lock = self._encode_locks.get(key)
+            if lock is None:
+                lock = self._encode_locks[key] = PriorityLock()
+            return lock
+
+    def evict(self, key: Hashable) -> None:
+        with self._lock:
+            self._models.pop(key, None)
+            self._sizes.pop(key, None)
+
+    def resident_sizes(self) -> Dict[Hashable, int]:
+        """各个驻留模型占用的内存（字节），按最近使用排序，最近使用的在最后"""
+        with self._lock:
+            return {key: self._sizes.get(key, 0) for key in self._models}
+
+    def preload(self, key: Hashable, loader: Callable[[], object], expected_size: int = 0,
+                model_path: Optional[str] = None) -> None:
+        """在后台线程中加载模型，已加载或正在加载时不做任何事"""
+        with self._lock:
+            if key in self._models or key in self._loading:
+                return
+
+        def run():
+            try:
+                self.get(key, loader, expected_size, model_path)
+            except Exception as e:
+                print(f"预加载模型 {key} 失败: {str(e)}")
+
+        threading.Thread(target=run, name=f'preload-{key}', daemon=True).start()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry() -> ModelRegistry:
+    """获取进程内共享的模型表，内存预算随配置更新"""
+    global _registry
+    budget_bytes = int(Config().embedding.model_memory_budget_mb * 1024 ** 2)
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry(budget_bytes)
+        else:
+            _registry.budget_bytes = budget_bytes
+        return _registry
@@ -0,0 +1,195 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import List, Optional
+
+import numpy as np
+
+"""
+本地嵌入模型的ONNX Runtime后端，适合只有CPU的机器
+首次使用时把模型目录中的transformers模型导出为<模型目录>/onnx/model.onnx，可选再做动态int8量化得到model_int8.onnx。
+稠密向量取[CLS]位置的隐藏状态并归一化，与BGEM3FlagModel的dense_vecs一致；encode的参数和返回值也与其保持一致。
+导出后与PyTorch的一致性检查结果保存在onnx文件旁边（如model.parity.json），检查未通过的导出不再重复尝试。
+权重超过protobuf单个文件2GB的上限时（如fp32的bge-m3），权重保存在onnx文件旁边的外部数据文件<onnx文件名>.data中。
+"""
+
+ONNX_DIR = 'onnx'
+# 导出后与PyTorch结果比对用的文本
+PARITY_TEXTS = ['你好', '今天天气真不错', '我太难了', '这也太离谱了吧哈哈哈', 'hello world', '不值得同情的']
+# protobuf单个文件的大小上限，留一些余量给计算图本身
+_PROTOBUF_LIMIT = 2 * 1024 ** 3 - 64 * 1024 ** 2
+
+
+def get_onnx_file(model_path: str, quantize_int8: bool) -> str:
+    return os.path.join(model_path, ONNX_DIR, 'model_int8.onnx' if quantize_int8 else 'model.onnx')
+
+
+def get_external_data_file(onnx_file: str) -> str:
+    return onnx_file + '.data'
+
+
+def get_model_size(onnx_file: str) -> int:
+    """onnx文件及其外部数据文件的总大小"""
+    size = os.path.getsize(onnx_file)
+    data_file = get_external_data_file(onnx_file)
+    if os.path.exists(data_file):
+        size += os.path.getsize(data_file)
+    return size
+
+
+def _move_into_place(tmp_file: str, target_file: str) -> None:
+    """把临时目录中导出的onnx文件移到目标位置，外部数据文件先移动，onnx文件存在即表示导出完成"""
+    tmp_data_file = get_external_data_file(tmp_file)
+    if os.path.exists(tmp_data_file):
+        os.replace(tmp_data_file, get_external_data_file(target_file))
+    os.replace(tmp_file, target_file)
+
+
+def get_parity_file(onnx_file: str) -> str:
+    return os.path.splitext(onnx_file)[0] + '.parity.json'
+
+
+def load_parity_result(onnx_file: str) -> Optional[float]:
+    """读取导出时一致性检查的最小余弦相似度，没有记录时返回None"""
+    path = get_parity_file(onnx_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return float(json.load(f)['min_cosine'])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"读取ONNX一致性检查结果 {path} 失败: {str(e)}")
+        return None
+
+
+def save_parity_result(onnx_file: str, min_cosine: float) -> None:
+    """记录一致性检查的最小余弦相似度；onnx文件被删除后记录仍然保留"""
+    path = get_parity_file(onnx_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'min_cosine': min_cosine}, f)
+
+
+def export_onnx(model_path: str, quantize_int8: bool = False) -> str:
+    """把模型导出为ONNX，需要时做动态int8量化，返回onnx文件路径；已导出时直接返回"""
+    fp32_file = get_onnx_file(model_path, False)
+    target_file = get_onnx_file(model_path, quantize_int8)
+    if os.path.exists(target_file):
+        return target_file
+
+    onnx_dir = os.path.dirname(fp32_file)
+    if not os.path.exists(fp32_file):
+        import onnx
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        print(f"正在导出ONNX模型 {fp32_file}...")
+        os.makedirs(onnx_dir, exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModel.from_pretrained(model_path).eval()
+        large = sum(p.numel() * p.element_size() for p in model.parameters()) > _PROTOBUF_LIMIT
+        inputs = tokenizer(['导出'], return_tensors='pt')
+        # 在临时目录中导出，超过2GB时torch会把权重拆成许多外部数据文件
+        tmp_dir = tempfile.mkdtemp(prefix='export', dir=onnx_dir)
+        try:
+            raw_file = os.path.join(tmp_dir, 'raw', os.path.basename(fp32_file))
+            os.makedirs(os.path.dirname(raw_file))
+            with torch.no_grad():
+                torch.onnx.export(
+                    model,
+                    (inputs['input_ids'], inputs['attention_mask']),
+                    raw_file,
+                    input_names=['input_ids', 'attention_mask'],
+                    output_names=['last_hidden_state'],
+                    dynamic_axes={
+                        'input_ids': {0: 'batch', 1: 'sequence'},
+                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                        'last_hidden_state': {0: 'batch', 1: 'sequence'},
+                    },
+                    opset_version=14,
+                )
+            tmp_file = os.path.join(tmp_dir, os.path.basename(fp32_file))
+            if large:
+                # 外部数据合并为一个<onnx文件名>.data文件
+                onnx.save_model(onnx.load(raw_file), tmp_file, save_as_external_data=True,
+                                all_tensors_to_one_file=True,
+                                location=os.path.basename(get_external_data_file(fp32_file)))
+            else:
+                os.replace(raw_file, tmp_file)
+            _move_into_place(tmp_file, fp32_file)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if quantize_int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print(f"正在量化ONNX模型 {target_file}...")
+        tmp_dir = tempfile.mkdtemp(prefix='quantize', dir=onnx_dir)
+        try:
+            tmp_file = os.path.join(tmp_dir, os.path.basename(target_file))
+            # 输入模型超过2GB时量化结果也要使用外部数据
+            quantize_dynamic(fp32_file, tmp_file, weight_type=QuantType.QInt8,
+                             use_external_data_format=get_model_size(fp32_file) > _PROTOBUF_LIMIT)
+            _move_into_place(tmp_file, target_file)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return target_file
+
+
+class OnnxEmbeddingModel:
+    """用ONNX Runtime在CPU上推理的嵌入模型，接口与BGEM3FlagModel的稠密向量部分一致"""
+
+    def __init__(self, model_path: str, quantize_int8: bool = False, intra_op_threads: int = 0):
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise RuntimeError(f"使用ONNX后端需要安装onnxruntime和transformers: {str(e)}")
+
+        self.model_path = model_path
+        self.quantize_int8 = quantize_int8
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        onnx_file = export_onnx(model_path, quantize_int8)
+        # 模型权重常驻内存的大小，按模型文件及其外部数据文件的大小估计
+        self.resident_size = get_model_size(onnx_file)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        # 单个模型内部并行即可，算子之间串行
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(onnx_file, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def encode(self, sentences, batch_size: int = 256, max_length: int = 512,
+               return_dense: bool = True, return_sparse: bool = False, return_colbert_vecs: bool = False):
+        """编码文本，返回{'dense_vecs': 归一化后的向量}；单个字符串返回一维向量"""
+        if return_sparse or return_colbert_vecs:
+            raise ValueError("ONNX后端只支持稠密向量")
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        outputs = []
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start:start + batch_size]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, max_length=max_length, return_tensors='np')
+            hidden = self.session.run(['last_hidden_state'], {
+                'input_ids': inputs['input_ids'].astype(np.int64),
+                'attention_mask': inputs['attention_mask'].astype(np.int64),
+            })[0]
+            cls = hidden[:, 0].astype(np.float32)
+            outputs.append(cls / np.linalg.norm(cls, axis=1, keepdims=True))
+        dense = np.concatenate(outputs, axis=0) if outputs else np.empty((0, 0), dtype=np.float32)
+        return {'dense_vecs': dense[0] if single else dense}
+
+
+def check_parity(onnx_model: OnnxEmbeddingModel, reference_model, texts: Optional[List[str]] = None) -> float:
+    """比较ONNX后端与PyTorch模型的归一化向量，返回逐条余弦相似度的最小值"""
+    texts = texts or PARITY_TEXTS
+    onnx_vecs = np.asarray(onnx_model.encode(texts)['dense_vecs'], dtype=np.float32)
+    reference = np.asarray(reference_model.encode(texts, return_dense=True, return_sparse=False,
+                                                  return_colbert_vecs=False)['dense_vecs'], dtype=np.float32)
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    return float(np.min(np.sum(onnx_vecs * reference, axis=1)))
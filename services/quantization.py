@@ -0,0 +1,61 @@
+from typing import List, Optional
+
+import numpy as np
+
+# 每次反量化参与矩阵乘法的行数，避免一次性展开成float32
+_SCORE_CHUNK_ROWS = 32768
+
+SUPPORTED_INDEX_DTYPES = ('float32', 'float16', 'int8')
+
+
+class QuantizedMatrix:
+    """压缩存储的嵌入矩阵，用于粗排
+
+    float16: 直接半精度存储，内存为float32的一半。
+    int8: 按维度做对称标量量化，scale[d] = max(|x[:, d]|) / 127，内存为float32的四分之一。
+    打分时分块反量化为float32再做矩阵乘法，结果是全精度相似度的近似值。
+    """
+
+    def __init__(self, dtype: str, data: np.ndarray, scale: Optional[np.ndarray] = None):
+        self.dtype = dtype
+        self.data = data
+        self.scale = scale
+
+    @classmethod
+    def quantize(cls, segments: List[np.ndarray], dtype: str) -> 'QuantizedMatrix':
+        """把若干float32分段逐段压缩为指定精度并拼接，不会整体展开全精度矩阵"""
+        if dtype == 'float16':
+            return cls(dtype, np.concatenate([np.asarray(segment, dtype=np.float16) for segment in segments]))
+        if dtype == 'int8':
+            scale = np.max([np.abs(segment).max(axis=0) for segment in segments], axis=0) / 127
+            scale[scale == 0] = 1
+            codes = np.concatenate([
+                np.clip(np.rint(np.asarray(segment, dtype=np.float32) / scale), -127, 127).astype(np.int8)
+                for segment in segments
+            ])
+            return cls(dtype, codes, scale.astype(np.float32))
+        raise ValueError(f"不支持的量化精度: {dtype}")
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+    def _scaled_queries(self, query_embeddings: np.ndarray) -> np.ndarray:
+        # int8: q·(codes*scale) = (q*scale)·codes，把scale乘到查询上，省去对整个矩阵的乘法
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if self.scale is not None:
+            return query_embeddings * self.scale
+        return query_embeddings
+
+    def score(self, query_embedding: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """计算近似相似度，rows为None时对所有行打分"""
+        return self.score_many(np.asarray(query_embedding)[None, :], rows)[0]
+
+    def score_many(self, query_embeddings: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """批量计算近似相似度，返回形状为(查询数, 行数)的矩阵"""
+        queries = self._scaled_queries(query_embeddings)
+        data = self.data if rows is None else self.data[rows]
+        scores = np.empty((queries.shape[0], data.shape[0]), dtype=np.float32)
+        for start in range(0, data.shape[0], _SCORE_CHUNK_ROWS):
+            chunk = data[start:start + _SCORE_CHUNK_ROWS].astype(np.float32)
+            scores[:, start:start + chunk.shape[0]] = queries @ chunk.T
+        return scores
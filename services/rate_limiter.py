@@ -0,0 +1,245 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, TypeVar
+
+import httpx
+import openai
+
+from config.settings import Config
+
+T = TypeVar('T')
+
+# 请求的优先级：交互式查询优先，批量生成缓存使用剩余的额度
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# 批量请求不会用掉令牌桶中最后这部分额度，留给随时可能到来的交互式查询
+_INTERACTIVE_RESERVE = 0.1
+
+# 令牌桶最多积攒多少秒的额度，避免空闲后瞬间发出一整分钟的请求
+_BURST_SECONDS = 10
+# 收到429后速率降为当前的该比例，之后每次成功恢复配置速率的一小部分
+_DECREASE_FACTOR = 0.5
+_INCREASE_STEP = 0.05
+_MIN_RATE_FACTOR = 0.05
+# 429响应没有Retry-After时的退避时间（秒），连续429时翻倍
+_DEFAULT_BACKOFF = 2
+_MAX_BACKOFF = 60
+# 连接错误和服务端错误重试前的等待时间（秒），每次翻倍
+_TRANSIENT_BACKOFF = 0.5
+
+
+class TokenBucket:
+    """令牌桶，rate_per_minute为每分钟补充的令牌数"""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = max(1.0, rate_per_minute / 60 * _BURST_SECONDS)
+        self.rate = rate_per_minute / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """还需要等待多少秒才有amount个令牌；超过桶容量的请求按容量计算"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """同时限制每分钟请求数(RPM)和每分钟token数(TPM)的限流器，rpm/tpm为0表示不限制
+
+    收到429时暂停到Retry-After指定的时间并把速率减半，之后每次成功逐步恢复到配置的速率。
+    有交互式请求在等待时批量请求让行，且批量请求不使用为交互式请求预留的额度。
+    所有重试都由这里发起，每次重试都重新占用额度；共享的客户端本身不重试，否则429会在限流器看到之前被SDK重试掉。
+    """
+
+    def __init__(self, name: str, rpm: int = 0, tpm: int = 0):
+        self.name = name
+        self._lock = threading.Lock()
+        self.last_request_time = 0.0
+        self._blocked_until = 0.0
+        self._consecutive_limited = 0
+        self._interactive_waiting = 0
+        self.configure(rpm, tpm)
+
+    def configure(self, rpm: int, tpm: int) -> None:
+        with self._lock:
+            self.rpm = rpm
+            self.tpm = tpm
+            self._rate_factor = 1.0
+            self._requests = TokenBucket(rpm) if rpm > 0 else None
+            self._tokens = TokenBucket(tpm) if tpm > 0 else None
+
+    def _wait_time(self, tokens: int, now: float, priority: int = PRIORITY_INTERACTIVE) -> float:
+        reserve = _INTERACTIVE_RESERVE if priority == PRIORITY_BULK else 0
+        wait = self._blocked_until - now
+        if self._requests is not None:
+            wait = max(wait, self._requests.wait_time(1 + self._requests.capacity * reserve, now))
+        if self._tokens is not None:
+            wait = max(wait, self._tokens.wait_time(tokens + self._tokens.capacity * reserve, now))
+        if priority == PRIORITY_BULK and self._interactive_waiting:
+            wait = max(wait, 0.05)
+        return wait
+
+    def try_acquire(self, tokens: int = 1, priority: int = PRIORITY_INTERACTIVE) -> bool:
+        """有额度时占用并返回True，否则立即返回False"""
+        with self._lock:
+            now = time.monotonic()
+            if self._wait_time(tokens, now, priority) > 0:
+                return False
+            if self._requests is not None:
+                self._requests.consume(1)
+            if self._tokens is not None:
+                self._tokens.consume(tokens)
+            self.last_request_time = time.time()
+            return True
+
+    def acquire(self, tokens: int = 1, priority: int = PRIORITY_INTERACTIVE) -> None:
+        """阻塞直到有一次请求和tokens个token的额度"""
+        interactive = priority == PRIORITY_INTERACTIVE
+        if interactive:
+            with self._lock:
+                self._interactive_waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    wait = self._wait_time(tokens, time.monotonic(), priority)
+                if wait <= 0 and self.try_acquire(tokens, priority):
+                    return
+                time.sleep(min(max(wait, 0.01), 1))
+        finally:
+            if interactive:
+                with self._lock:
+                    self._interactive_waiting -= 1
+
+    def is_saturated(self) -> bool:
+        """当前是否没有请求额度"""
+        with self._lock:
+            return self._wait_time(1, time.monotonic()) > 0
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """收到429：暂停到Retry-After之后，并降低速率"""
+        with self._lock:
+            self._consecutive_limited += 1
+            if retry_after is None:
+                retry_after = min(_MAX_BACKOFF, _DEFAULT_BACKOFF * 2 ** (self._consecutive_limited - 1))
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            self._set_rate_factor(max(_MIN_RATE_FACTOR, self._rate_factor * _DECREASE_FACTOR))
+        print(f"{self.name} 请求被限流，{retry_after:.1f}秒后重试")
+
+    def on_success(self) -> None:
+        """请求成功，逐步恢复速率"""
+        with self._lock:
+            self._consecutive_limited = 0
+            if self._rate_factor < 1.0:
+                self._set_rate_factor(min(1.0, self._rate_factor + _INCREASE_STEP))
+
+    def _set_rate_factor(self, factor: float) -> None:
+        self._rate_factor = factor
+        if self._requests is not None:
+            self._requests.rate = self.rpm * factor / 60
+        if self._tokens is not None:
+            self._tokens.rate = self.tpm * factor / 60
+
+    def call(self, fn: Callable[[], T], tokens: int = 1, max_retries: int = 3,
+             priority: int = PRIORITY_INTERACTIVE, transient_retries: Optional[int] = None) -> T:
+        """在限流下调用fn，遇到429时按Retry-After等待后重试，最多max_retries次
+
+        连接错误、超时和服务端错误最多重试transient_retries次，为None时取http.max_retries。
+        """
+        if transient_retries is None:
+            transient_retries = Config().http.max_retries
+        limited = 0
+        failed = 0
+        while True:
+            self.acquire(tokens, priority)
+            try:
+                result = fn()
+            except Exception as e:
+                if getattr(e, 'status_code', None) == 429 and limited < max_retries:
+                    limited += 1
+                    self.on_rate_limited(get_retry_after(e))
+                    continue
+                if is_transient_error(e) and failed < transient_retries:
+                    time.sleep(_TRANSIENT_BACKOFF * 2 ** failed)
+                    failed += 1
+                    continue
+                raise
+            self.on_success()
+            return result
+
+
+class PriorityLock:
+    """互斥锁，等待中的交互式请求总是先于批量请求获得锁"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._locked = False
+        self._waiting = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+
+    @contextmanager
+    def hold(self, priority: int = PRIORITY_INTERACTIVE):
+        with self._cond:
+            self._waiting[priority] += 1
+            while self._locked or (priority == PRIORITY_BULK and self._waiting[PRIORITY_INTERACTIVE]):
+                self._cond.wait()
+            self._waiting[priority] -= 1
+            self._locked = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._locked = False
+                self._cond.notify_all()
+
+
+def is_transient_error(error: Exception) -> bool:
+    """连接错误、超时和服务端5xx错误，重试可能成功"""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code >= 500
+    return isinstance(error, (openai.APIConnectionError, httpx.TransportError))
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """从429异常的响应头中读取Retry-After（秒）"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def estimate_tokens(*texts: str) -> int:
+    """粗略估计文本的token数，中文大约一个字一个token"""
+    return sum(len(text) for text in texts if text)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(endpoint: str) -> RateLimiter:
+    """获取进程内共享的限流器，endpoint为rate_limits配置中的键；配置变化时更新速率"""
+    limit = Config().rate_limits.get(endpoint)
+    rpm, tpm = (limit.rpm, limit.tpm) if limit is not None else (0, 0)
+    with _limiters_lock:
+        limiter = _limiters.get(endpoint)
+        if limiter is None:
+            limiter = _limiters[endpoint] = RateLimiter(endpoint, rpm, tpm)
+        elif (limiter.rpm, limiter.tpm) != (rpm, tpm):
+            limiter.configure(rpm, tpm)
+        return limiter
@@ -8,6 +8,7 @@ import numpy as np
 
 from config.settings import Config, ResourcePackConfig
 from services.utils import verify_folder, get_file_hash
+from services.index_store import columnar_cache_exists
 
 class ResourcePackManager:
     """资源包管理器，负责加载、解析和缓存资源包"""
@@ -25,6 +26,12 @@ class ResourcePackManager:
         
         # 加载所有资源包
         self._load_resource_packs()
+
+    def reload(self) -> None:
+        """重新读取配置并重新扫描资源包目录"""
+        self.config = Config()
+        self.enabled_packs = {}
+        self._load_resource_packs()
         
     def _load_resource_packs(self) -> None:
         """加载所有资源包信息"""
@@ -248,8 +255,8 @@ class ResourcePackManager:
         if not os.path.isabs(cache_file):
             cache_file = os.path.join(self.config.base_dir, cache_file)
             
-        # 打印调试信息
-        exists = os.path.exists(cache_file)
+        # 打印调试信息，列式缓存或尚未转换的pickle缓存都算已生成
+        exists = columnar_cache_exists(cache_file) or os.path.exists(cache_file)
         print(f"检查缓存文件: {cache_file}, 模型: {model_name}, 存在: {exists}")
             
         return exists
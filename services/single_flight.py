@@ -0,0 +1,73 @@
+import threading
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+"""
+相同请求的合并（single-flight）
+同一个键同一时间只有一个调用方真正去请求，其他并发的调用方等待并共享它的结果。
+一次请求可以包含多个键：调用方认领尚无人请求的键，对已在请求中的键等待结果。
+"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def claim(self, keys: Iterable[Hashable]) -> Tuple[List[Hashable], Dict[Hashable, _Call]]:
+        """认领键，返回(需要自己请求的键, {其他调用方正在请求的键: 等待对象})
+
+        认领的键必须通过resolve或reject结束，否则等待的调用方会一直阻塞。
+        """
+        owned = []
+        waiting = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                call = self._calls.get(key)
+                if call is None:
+                    self._calls[key] = _Call()
+                    owned.append(key)
+                else:
+                    waiting[key] = call
+        return owned, waiting
+
+    def resolve(self, key: Hashable, value) -> None:
+        """结束一个认领的键，把结果交给等待的调用方"""
+        with self._lock:
+            call = self._calls.pop(key, None)
+        if call is not None:
+            call.value = value
+            call.done.set()
+
+    def reject(self, keys: Iterable[Hashable], error: Exception) -> None:
+        """请求失败，等待这些键的调用方收到同样的异常；已经resolve的键忽略"""
+        with self._lock:
+            calls = [self._calls.pop(key) for key in keys if key in self._calls]
+        for call in calls:
+            call.error = error
+            call.done.set()
+
+
+_flights: Dict[str, SingleFlight] = {}
+_flights_lock = threading.Lock()
+
+
+def get_single_flight(name: str) -> SingleFlight:
+    """获取进程内共享的请求合并表，所有会话的相同请求互相合并"""
+    with _flights_lock:
+        flight = _flights.get(name)
+        if flight is None:
+            flight = _flights[name] = SingleFlight()
+        return flight
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+import weakref
+from typing import Callable, Iterable, Set
+
+from config.settings import Config
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+
+def scan_image_files(dirs: Iterable[str]) -> Set[str]:
+    """遍历目录，返回所有图片文件规范化后的路径"""
+    paths = set()
+    for folder in dirs:
+        for root, _, files in os.walk(folder):
+            for filename in files:
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.add(os.path.normpath(os.path.join(root, filename)))
+    return paths
+
+
+class ValidityMonitor:
+    """进程内共享的后台扫描线程，定期扫描所有订阅者的资源包目录，把同一份扫描结果交给每个订阅者更新有效位图
+
+    搜索时不再对每个结果调用os.path.exists，文件被删除后最多经过一个扫描周期才会从结果中消失。
+    每个周期所有会话的目录合并后只遍历一次。只持有订阅者的弱引用，订阅者被回收或取消订阅后不再通知，
+    没有订阅者时线程退出，下次订阅时重新启动。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        # 订阅者 -> (get_dirs(订阅者), on_scan(订阅者, 扫描到的路径集合))
+        self._subscribers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._thread = None
+
+    def subscribe(self, owner, get_dirs: Callable[[object], Iterable[str]],
+                  on_scan: Callable[[object, Set[str]], None]) -> None:
+        with self._lock:
+            self._subscribers[owner] = (get_dirs, on_scan)
+            if self.interval > 0 and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='validity-monitor', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._subscribers or self.interval <= 0:
+                    self._thread = None
+                    return
+            self._scan()
+
+    def _scan(self) -> None:
+        """扫描一次并通知所有订阅者，订阅者的强引用只在这次调用期间持有"""
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        try:
+            dirs = set()
+            for owner, (get_dirs, _) in subscribers:
+                dirs.update(get_dirs(owner))
+            existing_paths = scan_image_files(sorted(dirs))
+        except Exception as e:
+            print(f"扫描资源包目录失败: {str(e)}")
+            return
+        for owner, (_, on_scan) in subscribers:
+            try:
+                on_scan(owner, existing_paths)
+            except Exception as e:
+                print(f"更新失效图片失败: {str(e)}")
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def get_validity_monitor() -> ValidityMonitor:
+    """获取进程内共享的扫描线程，扫描间隔随配置更新"""
+    global _monitor
+    interval = Config().search.validity_scan_interval
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = ValidityMonitor(interval)
+        else:
+            _monitor.interval = interval
+        return _monitor
@@ -0,0 +1,277 @@
+import atexit
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config.settings import Config
+
+"""
+基于SQLite的文本嵌入向量存储
+每条记录以(模型标识, 文本)为主键，向量以float16或float32的二进制blob保存，支持单点查询。
+模型标识是模型的HuggingFace仓库名，API和本地加载的同一模型共用一个标识，两种模式读写同一份向量。
+写入先进入内存缓冲区，由后台线程定期批量写盘；超过容量上限时按最近使用时间淘汰，淘汰较多后压缩数据库文件。
+进程内所有会话通过get_vector_store共用一个实例，一个会话写入缓冲区的向量其他会话立即可见。
+"""
+
+SUPPORTED_STORE_DTYPES = ('float16', 'float32')
+# SQLite单条语句的参数个数上限为999
+_SQL_IN_CHUNK = 900
+# 淘汰的条目累计超过容量的该比例时执行VACUUM压缩文件
+_COMPACT_RATIO = 0.25
+
+
+class VectorStore:
+    def __init__(self, path: str, dtype: str = 'float16', max_entries: int = 0, flush_interval: float = 5):
+        if dtype not in SUPPORTED_STORE_DTYPES:
+            raise ValueError(f"不支持的向量存储精度: {dtype}")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        # (模型, 文本) -> (向量, 写入时间)
+        self._pending: Dict[tuple, Tuple[np.ndarray, float]] = {}
+        self._touched: Dict[tuple, float] = {}
+        self._evicted_since_compact = 0
+        # 数据库中的条目数，第一次需要淘汰时统计一次，之后随写入和淘汰增减
+        self._count: Optional[int] = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS vectors ('
+            'model TEXT NOT NULL, text TEXT NOT NULL, dtype TEXT NOT NULL, data BLOB NOT NULL, '
+            'last_used REAL NOT NULL, PRIMARY KEY (model, text))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_vectors_last_used ON vectors (last_used)')
+        # 一致性检查结果等少量键值
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.commit()
+
+        self._stop_event = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._run_flusher, args=(flush_interval,),
+                                             name='vector-store-flusher', daemon=True)
+            self._flusher.start()
+        atexit.register(self.close)
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        """查询单个文本的向量，返回float32数组；不存在时返回None"""
+        return self.get_many(model, [text]).get(text)
+
+    def get_many(self, model: str, texts: Iterable[str]) -> Dict[str, np.ndarray]:
+        """批量查询，返回命中的{文本: float32向量}"""
+        texts = list(dict.fromkeys(texts))
+        found = {}
+        now = time.time()
+        with self._lock:
+            remaining = []
+            for text in texts:
+                entry = self._pending.get((model, text))
+                if entry is None:
+                    remaining.append(text)
+                else:
+                    found[text] = entry[0].astype(np.float32)
+            for start in range(0, len(remaining), _SQL_IN_CHUNK):
+                chunk = remaining[start:start + _SQL_IN_CHUNK]
+                rows = self._conn.execute(
+                    f'SELECT text, dtype, data FROM vectors WHERE model = ? AND text IN ({",".join("?" * len(chunk))})',
+                    [model, *chunk]
+                ).fetchall()
+                for text, dtype, data in rows:
+                    found[text] = np.frombuffer(data, dtype=dtype).astype(np.float32)
+            # 最近使用时间在下次写盘时批量更新，查询本身不写数据库
+            for text in found:
+                self._touched[(model, text)] = now
+        return found
+
+    def sample_texts(self, model: str, limit: int) -> List[str]:
+        """取该模型最近使用的至多limit条文本，用于一致性检查"""
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT text FROM vectors WHERE model = ? ORDER BY last_used DESC LIMIT ?', (model, limit)
+            ).fetchall()
+        return [text for text, in rows]
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+            self._conn.commit()
+
+    def put(self, model: str, text: str, vector) -> None:
+        """写入向量，先进入缓冲区，由后台线程或flush写盘"""
+        with self._lock:
+            self._pending[(model, text)] = (np.asarray(vector, dtype=self.dtype), time.time())
+
+    def flush(self) -> None:
+        """把缓冲区写入数据库，并按容量上限淘汰最久未使用的条目；淘汰较多时在锁外压缩数据库"""
+        needs_compact = False
+        with self._lock:
+            if not self._pending and not self._touched:
+                return
+            pending, self._pending = self._pending, {}
+            touched, self._touched = self._touched, {}
+            try:
+                new_rows = len(pending) - self._count_existing(pending.keys()) if self.max_entries > 0 else 0
+                # 最近使用时间取写入时间和之后最后一次查询时间中较晚的
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO vectors (model, text, dtype, data, last_used) VALUES (?, ?, ?, ?, ?)',
+                    [(model, text, vector.dtype.name, vector.tobytes(),
+                      max(put_time, touched.pop((model, text), put_time)))
+                     for (model, text), (vector, put_time) in pending.items()]
+                )
+                self._conn.executemany(
+                    'UPDATE vectors SET last_used = ? WHERE model = ? AND text = ?',
+                    [(last_used, model, text) for (model, text), last_used in touched.items()]
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                # 写盘失败时放回缓冲区，下次再试
+                print(f"保存嵌入向量失败: {str(e)}")
+                self._conn.rollback()
+                for key, entry in pending.items():
+                    self._pending.setdefault(key, entry)
+                return
+            if self._count is not None:
+                self._count += new_rows
+            self._evict()
+            if self.max_entries > 0 and self._evicted_since_compact >= self.max_entries * _COMPACT_RATIO:
+                self._evicted_since_compact = 0
+                needs_compact = True
+        if needs_compact:
+            self.compact()
+
+    def _count_existing(self, keys: Iterable[tuple]) -> int:
+        """统计这些(模型, 文本)中已在数据库里的条数，只按主键查询，与数据库大小无关"""
+        texts_by_model: Dict[str, List[str]] = {}
+        for model, text in keys:
+            texts_by_model.setdefault(model, []).append(text)
+        count = 0
+        for model, texts in texts_by_model.items():
+            for start in range(0, len(texts), _SQL_IN_CHUNK):
+                chunk = texts[start:start + _SQL_IN_CHUNK]
+                count += self._conn.execute(
+                    f'SELECT COUNT(*) FROM vectors WHERE model = ? AND text IN ({",".join("?" * len(chunk))})',
+                    [model, *chunk]
+                ).fetchone()[0]
+        return count
+
+    def _evict(self) -> None:
+        if self.max_entries <= 0:
+            return
+        if self._count is None:
+            self._count = len(self)
+        overflow = self._count - self.max_entries
+        if overflow <= 0:
+            return
+        deleted = self._conn.execute(
+            'DELETE FROM vectors WHERE rowid IN (SELECT rowid FROM vectors ORDER BY last_used LIMIT ?)',
+            (overflow,)
+        ).rowcount
+        self._conn.commit()
+        self._count -= deleted
+        self._evicted_since_compact += deleted
+
+    def compact(self) -> None:
+        """压缩数据库文件，回收被淘汰条目占用的空间
+
+        使用单独的连接且不持有存储的锁，压缩期间查询照常进行（WAL模式下读不受影响）。
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('VACUUM')
+        except sqlite3.Error as e:
+            print(f"压缩嵌入向量存储失败: {str(e)}")
+        finally:
+            conn.close()
+
+    def import_vectors(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        """批量导入{文本: 向量}，用于从旧缓存迁移"""
+        now = time.time()
+        with self._lock:
+            for text, vector in vectors.items():
+                self._pending[(model, text)] = (np.asarray(vector, dtype=self.dtype), now)
+        self.flush()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM vectors').fetchone()[0]
+
+    def _run_flusher(self, interval: float) -> None:
+        while not self._stop_event.wait(interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"保存嵌入向量失败: {str(e)}")
+
+    def close(self) -> None:
+        """停止后台线程，写入剩余的缓冲区并关闭数据库"""
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._conn.close()
+
+
+_store: Optional[VectorStore] = None
+_store_lock = threading.Lock()
+
+
+def get_vector_store() -> VectorStore:
+    """获取进程内共享的向量存储；容量上限变化时直接更新，存储文件或精度变化时重新打开"""
+    global _store
+    embedding_config = Config().embedding
+    path = Config().get_abs_api_store_file()
+    with _store_lock:
+        if _store is None or _store.path != path or _store.dtype != np.dtype(embedding_config.api_cache_dtype):
+            # 旧的实例可能仍被其他线程使用，不主动关闭，由它自己的写盘线程和退出时的close写完缓冲区
+            _store = VectorStore(path,
+                                 dtype=embedding_config.api_cache_dtype,
+                                 max_entries=embedding_config.api_cache_max_entries,
+                                 flush_interval=embedding_config.api_cache_flush_interval)
+        else:
+            _store.max_entries = embedding_config.api_cache_max_entries
+        return _store
+
+
+def migrate_pickle_vectors(pickle_file: str, store: VectorStore, model: Optional[str] = None) -> bool:
+    """把旧的pickle嵌入缓存一次性导入store，成功后旧文件重命名为.pkl.migrated
+
+    model为None时文件内容为{模型名: {文本: 向量}}（API模式的旧缓存），
+    否则为单个模型的{文本: 向量}（本地模式的旧缓存），导入到model下。
+    """
+    if not os.path.exists(pickle_file):
+        return False
+    try:
+        with open(pickle_file, 'rb') as f:
+            cached = pickle.load(f)
+    except (pickle.UnpicklingError, EOFError, OSError) as e:
+        print(f"加载嵌入缓存 {pickle_file} 失败: {str(e)}")
+        return False
+    if not isinstance(cached, dict):
+        print(f"警告: 嵌入缓存格式不正确，期望字典但得到 {type(cached)}")
+        return False
+    if model is not None:
+        cached = {model: cached}
+    for model_name, vectors in cached.items():
+        if isinstance(vectors, dict):
+            store.import_vectors(model_name, vectors)
+    os.replace(pickle_file, pickle_file + '.migrated')
+    print(f"嵌入缓存 {pickle_file} 已导入 {store.path}")
+    return True